@@ -35,18 +35,27 @@ import argparse
 from .drive import Drive
 # Load ORbot
 from .orbot import ORbot, get_version
+from .transport import stand_in
 
 
 def main():
     parser = argparse.ArgumentParser(description='Officine Robotiche bot manager')
     parser.add_argument('-s', dest="settings", help='path of setting file', default='config/settings.json')
     parser.add_argument('-v', '--version', action='version', version='%(prog)s {version}'.format(version=get_version()))
+    parser.add_argument('--stand-in', dest="stand_in", help='POST synthetic updates to a local webhook url and exit')
+    parser.add_argument('-n', dest="count", type=int, help='number of synthetic updates', default=100)
     # Google Drive
     #drive = Drive(settings['drive'])
     #drive.testDrive()
     #drive.upload()
     # Parse arguments
     args = parser.parse_args()
+    # Test the webhook latency
+    if args.stand_in:
+        timings = stand_in(args.stand_in, args.count)
+        print(f"Sent {len(timings)} updates avg {sum(timings) / len(timings):.3f}s max {max(timings):.3f}s")
+        print("Update to handler latency is in /stats")
+        return
     # Telegram ORbot
     try:
         orbot = ORbot(args.settings)
@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import logging
+from functools import partial
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Default number of threads for blocking calls
+AIO_WORKERS = 2
+
+
+class AsyncLoop:
+    """ An asyncio event loop running in its own thread, only for the work
+        that waits the outbox: messages are awaited without keep busy a thread.
+        The few blocking calls left run on a small pool.
+    """
+
+    def __init__(self, workers=AIO_WORKERS):
+        self.loop = asyncio.new_event_loop()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='aio')
+        self.loop.set_default_executor(self.pool)
+        self.thread = Thread(target=self.loop.run_forever, name="aio", daemon=True)
+        self.thread.start()
+        self.tasks = 0
+
+    def run(self, coro):
+        """ Run a coroutine from any thread, return a concurrent future """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        self.tasks += 1
+        future.add_done_callback(self.task_done)
+        return future
+
+    def task_done(self, future):
+        self.tasks -= 1
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Task failed: {future.exception()}")
+
+    async def blocking(self, func, *args, **kwargs):
+        """ Run a blocking function on the pool """
+        return await self.loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+    async def send(self, bot, name, *args, **kwargs):
+        """ Queue a message in the outbox and wait the result without a thread """
+        future = self.loop.create_future()
+
+        def resolve(job):
+            if future.cancelled():
+                return
+            if job.error is not None:
+                future.set_exception(job.error)
+            else:
+                future.set_result(job.result)
+
+        job = bot.submit(name, *args, **kwargs)
+        job.add_done_callback(lambda job: self.loop.call_soon_threadsafe(resolve, job))
+        return await future
+
+    def stats(self):
+        return {'tasks': self.tasks}
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.pool.shutdown(wait=True)
+# EOF
@@ -28,16 +28,34 @@
 # OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
 # EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import os
+import json
+import asyncio
+from time import sleep, monotonic
 from uuid import uuid4
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, ConversationHandler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Bot, TelegramError
+from telegram.error import NetworkError, BadRequest
 import logging
 # Menu 
-from .utils import build_menu, check_key_id, isAdmin, filter_channel, restricted, rtype
+from .utils import build_menu, check_key_id, isAdmin, filter_channel, restricted, rtype, save_config
 from telegram.utils.helpers import escape_markdown
+from .outbox import BULK
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+# Announce jobs in progress
+ANNOUNCE_FILE = "announce.json"
+# Number of parallel forward
+FANOUT_WORKERS = 4
+# Number of forward in flight with the event loop
+FANOUT_INFLIGHT = 256
+# Number of attempts for each chat
+FANOUT_RETRY = 3
+# Minimum time between two progress messages
+FANOUT_PROGRESS = 2
 
 def send_message(chat_id, context, keyID, reply_markup):
     message = context.user_data[keyID]['message']
@@ -71,18 +89,150 @@ def edit_message(update, context, keyID, message, reply_markup):
 
 class Announce:
 
-    def __init__(self, updater, settings, settings_file, channels):
+    def __init__(self, updater, settings, settings_file, channels, aio=None):
         self.updater = updater
         self.settings_file = settings_file
         self.settings = settings
         self.channels = channels
-        # Get the dispatcher to register handlers
-        dp = self.updater.dispatcher
+        # Event loop for the fan-out, otherwise threads
+        self.aio = aio
+        # Register handlers
+        self.add_handlers(self.updater.dispatcher)
+        # Restore all announce in progress
+        self.jobs_file = os.path.join(os.path.dirname(self.settings_file), ANNOUNCE_FILE)
+        self.jobs_lock = Lock()
+        self.jobs = {}
+        if os.path.isfile(self.jobs_file):
+            try:
+                with open(self.jobs_file) as stream:
+                    self.jobs = json.load(stream)
+            except ValueError as e:
+                # Written from an old version without the atomic save
+                logger.error(f"Announce not restored, {self.jobs_file} is not valid: {e}")
+        for job_id in self.jobs:
+            logger.info(f"Restore announce {job_id}")
+            self.fanout_start(job_id)
+
+    def add_handlers(self, dp):
         dp.add_handler(CommandHandler('announce', self.announce))
         dp.add_handler(CallbackQueryHandler(self.announce_select, pattern='AN_SELECT'))
         dp.add_handler(CallbackQueryHandler(self.announce_send, pattern='AN_SEND'))
         dp.add_handler(CallbackQueryHandler(self.announce_cancel, pattern='AN_CANCEL'))
 
+    def fanout_start(self, job_id):
+        if self.aio is not None:
+            self.aio.run(self.fanout_async(job_id))
+        else:
+            Thread(target=self.fanout, args=(job_id,), daemon=True).start()
+
+    def fanout_forward(self, job, chat_id):
+        """ Forward a message and retry on temporary errors """
+        bot = self.updater.bot
+        for attempt in range(FANOUT_RETRY):
+            try:
+                bot.forward_message(chat_id=chat_id, from_chat_id=job['from_chat_id'], message_id=job['message_id'], priority=BULK)
+                return True
+            except BadRequest as e:
+                # Chat not available
+                logger.warning(f"Announce not sent in {chat_id}: {e}")
+                return False
+            except NetworkError as e:
+                logger.warning(f"Announce in {chat_id} retry {attempt + 1}: {e}")
+                sleep(2 ** attempt)
+            except TelegramError as e:
+                logger.warning(f"Announce not sent in {chat_id}: {e}")
+                return False
+        return False
+
+    def fanout_progress(self, job, final=False):
+        n_done = len(job['done'])
+        n_failed = len(job['failed'])
+        text = f"*Announce* {job['title']} Sent!\n"
+        text += f"📢📢📢 {n_done + n_failed}/{len(job['chats'])} channels"
+        if n_failed:
+            text += f" ({n_failed} failed)"
+        if not final:
+            text += "..."
+        try:
+            if job['photo']:
+                self.updater.bot.edit_message_caption(chat_id=job['admin_chat'], message_id=job['admin_msg'], caption=text, parse_mode='Markdown')
+            else:
+                self.updater.bot.edit_message_text(chat_id=job['admin_chat'], message_id=job['admin_msg'], text=text, parse_mode='Markdown')
+        except TelegramError as e:
+            logger.warning(f"Announce progress not updated: {e}")
+
+    def fanout_chats(self, job):
+        return [chat_id for chat_id in job['chats'] if chat_id not in job['done'] + job['failed']]
+
+    def fanout_done(self, job, chat_id, status, last):
+        """ Store the chat sent, return True if is time to update the progress """
+        with self.jobs_lock:
+            job['done' if status else 'failed'].append(chat_id)
+            save_config(self.jobs_file, self.jobs)
+            # Do not edit the admin message for every chat
+            progress = monotonic() - last['progress'] > FANOUT_PROGRESS
+            if progress:
+                last['progress'] = monotonic()
+        return progress
+
+    def fanout_end(self, job_id):
+        job = self.jobs[job_id]
+        # Remove job
+        with self.jobs_lock:
+            del self.jobs[job_id]
+            save_config(self.jobs_file, self.jobs)
+        self.fanout_progress(job, final=True)
+        logger.info(f"Announce {job_id} done in {len(job['done'])} chats, failed {len(job['failed'])}")
+
+    def fanout(self, job_id):
+        """ Forward an announce in all chats, the state is stored after every chat """
+        job = self.jobs[job_id]
+        last = {'progress': monotonic()}
+
+        def forward(chat_id):
+            status = self.fanout_forward(job, chat_id)
+            if self.fanout_done(job, chat_id, status, last):
+                self.fanout_progress(job)
+
+        with ThreadPoolExecutor(max_workers=FANOUT_WORKERS) as executor:
+            list(executor.map(forward, self.fanout_chats(job)))
+        self.fanout_end(job_id)
+
+    async def fanout_forward_async(self, job, chat_id):
+        """ Same of fanout_forward, wait in the outbox without a thread """
+        bot = self.updater.bot
+        for attempt in range(FANOUT_RETRY):
+            try:
+                await self.aio.send(bot, 'forward_message', chat_id=chat_id, from_chat_id=job['from_chat_id'],
+                                    message_id=job['message_id'], priority=BULK)
+                return True
+            except BadRequest as e:
+                # Chat not available
+                logger.warning(f"Announce not sent in {chat_id}: {e}")
+                return False
+            except NetworkError as e:
+                logger.warning(f"Announce in {chat_id} retry {attempt + 1}: {e}")
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                logger.warning(f"Announce not sent in {chat_id}: {e}")
+                return False
+        return False
+
+    async def fanout_async(self, job_id):
+        """ Forward an announce in all chats with the event loop """
+        job = self.jobs[job_id]
+        last = {'progress': monotonic()}
+        inflight = asyncio.Semaphore(FANOUT_INFLIGHT)
+
+        async def forward(chat_id):
+            async with inflight:
+                status = await self.fanout_forward_async(job, chat_id)
+            if self.fanout_done(job, chat_id, status, last):
+                await self.aio.blocking(self.fanout_progress, job)
+
+        await asyncio.gather(*[forward(chat_id) for chat_id in self.fanout_chats(job)])
+        await self.aio.blocking(self.fanout_end, job_id)
+
     @filter_channel
     @rtype(['private', 'channel'])
     def announce(self, update, context):
@@ -125,7 +275,7 @@ class Announce:
             # Send a message to the admin user
             buttons = []
             for chat_id in self.settings['channels']:
-                chat = context.bot.getChat(chat_id)
+                chat = self.channels.getChat(context.bot, chat_id)
                 if chat.type == 'channel':
                     icons = self.channels.getIcons(context, chat_id)
                     buttons += [InlineKeyboardButton(icons + chat.title, callback_data=f"AN_SELECT {keyID} {chat_id}")]
@@ -141,7 +291,7 @@ class Announce:
     def type_announce(self, update, context, keyID):
         message = context.user_data[keyID]['message']
         chat_id = context.user_data[keyID]['chat_id']
-        chat = context.bot.getChat(chat_id)
+        chat = self.channels.getChat(context.bot, chat_id)
         message = f"*Announce* {chat.title}:\n{message}"
         # Second message ask
         buttons = [InlineKeyboardButton("📢 Announce", callback_data=f"AN_SEND {keyID}"),
@@ -200,7 +350,7 @@ class Announce:
         main_chat = context.user_data[keyID]['main_chat']
         photo = context.user_data[keyID]['photo']
         rm = context.user_data[keyID]['reply_markup']
-        chat = context.bot.getChat(chat_id)
+        chat = self.channels.getChat(context.bot, chat_id)
         #Send message
         msg = self.sendAnnounce(update, context, chat_id, rm)
         context.bot.forward_message(chat_id=update.effective_user.id, from_chat_id=chat_id, message_id=msg.message_id)
@@ -209,12 +359,6 @@ class Announce:
         all = False
         if len(data) > 2:
             all = True if data[2] == 'ALL' else False
-        if all:
-            ch_all = list(self.settings['channels'].keys())
-            logger.info(f"Send in all other {len(ch_all)} chats")
-            # Difference list between all channels and main chat
-            for n_chat_id in [value for value in ch_all if value not in [chat_id, str(main_chat)]]:
-                context.bot.forward_message(chat_id=n_chat_id, from_chat_id=chat_id, message_id=msg.message_id)
         # remove key from user_data list
         del context.user_data[keyID]
         # edit message
@@ -222,6 +366,24 @@ class Announce:
             query.edit_message_caption(caption=f"*Announce* {chat.title} Sent!", parse_mode='Markdown')
         else:
             query.edit_message_text(text=f"*Announce* {chat.title} Sent!", parse_mode='Markdown')
+        if all:
+            ch_all = list(self.settings['channels'].keys())
+            logger.info(f"Send in all other {len(ch_all)} chats")
+            # Difference list between all channels and main chat
+            job_id = str(uuid4())
+            with self.jobs_lock:
+                self.jobs[job_id] = {'from_chat_id': chat_id,
+                                     'message_id': msg.message_id,
+                                     'chats': [value for value in ch_all if value not in [str(chat_id), str(main_chat)]],
+                                     'done': [],
+                                     'failed': [],
+                                     'title': chat.title,
+                                     'photo': bool(photo),
+                                     'admin_chat': query.message.chat.id,
+                                     'admin_msg': query.message.message_id}
+                save_config(self.jobs_file, self.jobs)
+            # Forward in background
+            self.fanout_start(job_id)
 
     @check_key_id('Error message')
     def announce_cancel(self, update, context):
@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import logging
+import zipfile
+from time import localtime
+from hashlib import sha1
+from threading import Lock
+
+from .formats import FORMATS, path_format, header, split_part, record_parts, record_lines
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Cache folder inside the records folder
+ARCHIVES_FOLDER = ".archives"
+# Maximum size of all archives cached
+ARCHIVES_SIZE = 256 * 1024 * 1024
+# Temporary files never in an archive
+PARTIAL = ('.part', '.tmp')
+# Files already compressed, stored without deflate
+STORED = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.ogg', '.oga', '.opus', '.mp3', '.m4a',
+          '.mp4', '.mov', '.webm', '.zip', '.gz', '.zst', '.7z', '.rar', '.docx', '.xlsx', '.pptx']
+
+
+def compress_type(file_name):
+    if os.path.splitext(file_name)[1].lower() in STORED:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def folder_key(path):
+    """ Hash of the name, size and time of all files in a folder """
+    key = sha1()
+    for file_name in sorted(os.listdir(path)):
+        stat = os.stat(os.path.join(path, file_name))
+        key.update(f"{file_name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return key.hexdigest()[:16]
+
+
+class Archives:
+    """ Zip archives of the records, built once for each version of a record folder.
+        The media are stored and not compressed again.
+    """
+
+    def __init__(self, records_folder, size=ARCHIVES_SIZE):
+        self.folder = os.path.join(records_folder, ARCHIVES_FOLDER)
+        self.size = size
+        self.lock = Lock()
+        # Statistics
+        self.hits = 0
+        self.builds = 0
+
+    def build(self, path, archive):
+        tmp = f"{archive}.tmp"
+        with zipfile.ZipFile(tmp, 'w') as zipObj:
+            for file_name in sorted(os.listdir(path)):
+                file_path = os.path.join(path, file_name)
+                # Skip the files not complete
+                if not os.path.isfile(file_path) or file_name.endswith(PARTIAL):
+                    continue
+                # The parts are in the file of the record
+                if split_part(file_name)[1]:
+                    continue
+                if len(record_parts(file_path)) > 1:
+                    self.merge(zipObj, file_path, file_name)
+                else:
+                    zipObj.write(file_path, file_name, compress_type=compress_type(file_name))
+        os.replace(tmp, archive)
+
+    def merge(self, zipObj, path, file_name):
+        """ A record with all its parts in one file not compressed, the first part can end broken after a crash """
+        name = path_format(file_name)
+        extension = 'csv' if name == 'tsv' else 'jsonl'
+        info = zipfile.ZipInfo(f"{file_name[:-len(FORMATS[name]) - 1]}.{extension}", date_time=localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with zipObj.open(info, 'w') as stream:
+            stream.write(header(name).encode())
+            for line in record_lines(path):
+                stream.write(line.encode())
+
+    def get(self, path, name):
+        """ Path of the archive of a record folder, name is the folder identifier """
+        with self.lock:
+            if not os.path.isdir(self.folder):
+                os.makedirs(self.folder)
+            key = folder_key(path)
+            archive = os.path.join(self.folder, f"{name}-{key}.zip")
+            if os.path.isfile(archive):
+                self.hits += 1
+                # Used now, the last to be removed
+                os.utime(archive)
+                return archive
+            # Remove the old versions of the same record
+            for file_name in os.listdir(self.folder):
+                if file_name.startswith(f"{name}-"):
+                    os.remove(os.path.join(self.folder, file_name))
+            self.build(path, archive)
+            self.builds += 1
+            logger.info(f"Archive {archive} built")
+            self.trim()
+            return archive
+
+    def trim(self):
+        """ Remove the archives used less recently over the maximum size """
+        files = [os.path.join(self.folder, file_name) for file_name in os.listdir(self.folder)]
+        files = sorted(files, key=os.path.getmtime, reverse=True)
+        total = 0
+        for file_path in files:
+            total += os.path.getsize(file_path)
+            # Keep always the last archive
+            if total > self.size and file_path != files[0]:
+                os.remove(file_path)
+
+    def stats(self):
+        return {'hits': self.hits, 'builds': self.builds}
+# EOF
@@ -0,0 +1,213 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+from time import monotonic
+from threading import Lock
+from telegram.error import TelegramError, TimedOut, RetryAfter
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Default time to live in seconds
+CHAT_TTL = 60 * 60
+MEMBER_TTL = 30 * 60
+ADMIN_TTL = 10 * 60
+# Status of an administrator
+ADMINISTRATOR = ['administrator', 'creator']
+# Status of a user outside the chat
+NOT_MEMBER = ['left', 'kicked']
+# Membership not in the index, None is a lookup failed
+UNKNOWN = 'unknown'
+
+
+class ChatCache:
+    """ Shared cache of chat metadata (title, type, invite_link, description)
+        Every entry expires after ttl seconds or when is invalidated
+    """
+
+    def __init__(self, ttl=CHAT_TTL):
+        self.ttl = ttl
+        self.chats = {}
+        self.lock = Lock()
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bot, chat_id):
+        key = int(chat_id)
+        with self.lock:
+            entry = self.chats.get(key)
+            if entry is not None and monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+        # Load chat from telegram, errors are not cached
+        chat = bot.getChat(key)
+        with self.lock:
+            self.misses += 1
+            self.chats[key] = (monotonic(), chat)
+        return chat
+
+    def invalidate(self, chat_id=None):
+        with self.lock:
+            if chat_id is None:
+                self.chats.clear()
+            else:
+                self.chats.pop(int(chat_id), None)
+        logger.debug(f"Chat cache invalidate {chat_id}")
+
+    def stats(self):
+        return {'chats': len(self.chats), 'hits': self.hits, 'misses': self.misses}
+
+
+class MemberCache:
+    """ Local index of the (chat_id, user_id) membership
+        The index is seeded lazily with get_chat_member and kept current from
+        the chat member updates. An entry older than ttl is loaded again.
+    """
+
+    def __init__(self, ttl=MEMBER_TTL):
+        self.ttl = ttl
+        self.members = {}
+        self.lock = Lock()
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def status(self, bot, chat_id, user_id):
+        key = (int(chat_id), int(user_id))
+        with self.lock:
+            entry = self.members.get(key)
+            if entry is not None and monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+        try:
+            status = bot.get_chat_member(key[0], key[1]).status
+        except (TimedOut, RetryAfter):
+            # Temporary errors are not stored
+            return None
+        except TelegramError:
+            # User or chat not available
+            status = None
+        with self.lock:
+            self.misses += 1
+        self.update(key[0], key[1], status)
+        return status
+
+    def cached(self, chat_id, user_id):
+        """ Status from the index without API calls, UNKNOWN if not in the index """
+        with self.lock:
+            entry = self.members.get((int(chat_id), int(user_id)))
+            if entry is not None and monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+        return UNKNOWN
+
+    def update(self, chat_id, user_id, status):
+        with self.lock:
+            self.members[(int(chat_id), int(user_id))] = (monotonic(), status)
+
+    def isMember(self, bot, chat_id, user_id):
+        status = self.status(bot, chat_id, user_id)
+        return status is not None and status not in NOT_MEMBER
+
+    def invalidate(self, chat_id=None):
+        with self.lock:
+            if chat_id is None:
+                self.members.clear()
+            else:
+                for key in [key for key in self.members if key[0] == int(chat_id)]:
+                    del self.members[key]
+
+    def stats(self):
+        return {'members': len(self.members), 'hits': self.hits, 'misses': self.misses}
+
+
+class AdminCache:
+    """ Roster of the administrators of each chat keyed by user id
+        The roster is refreshed from a background job and updated by the
+        chat member updates.
+    """
+
+    def __init__(self, ttl=ADMIN_TTL):
+        self.ttl = ttl
+        self.admins = {}
+        self.lock = Lock()
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def roster(self, bot, chat_id, refresh=False):
+        key = int(chat_id)
+        with self.lock:
+            entry = self.admins.get(key)
+            if not refresh and entry is not None and monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+        try:
+            admins = set(member.user.id for member in bot.getChatAdministrators(key))
+        except (TimedOut, RetryAfter):
+            # Use the old roster if available
+            return entry[1] if entry is not None else set()
+        except TelegramError:
+            # Private chat or bot not in chat
+            admins = set()
+        with self.lock:
+            self.misses += 1
+            self.admins[key] = (monotonic(), admins)
+        return admins
+
+    def isAdmin(self, bot, chat_id, user_id):
+        return int(user_id) in self.roster(bot, chat_id)
+
+    def update(self, chat_id, user_id, status):
+        with self.lock:
+            entry = self.admins.get(int(chat_id))
+            # Wait the next refresh if the roster is not loaded
+            if entry is None:
+                return
+            if status in ADMINISTRATOR:
+                entry[1].add(int(user_id))
+            else:
+                entry[1].discard(int(user_id))
+
+    def refresh(self, bot, chats):
+        for chat_id in chats:
+            self.roster(bot, chat_id, refresh=True)
+
+    def invalidate(self, chat_id=None):
+        with self.lock:
+            if chat_id is None:
+                self.admins.clear()
+            else:
+                self.admins.pop(int(chat_id), None)
+
+    def stats(self):
+        return {'rosters': len(self.admins), 'hits': self.hits, 'misses': self.misses}
+# EOF
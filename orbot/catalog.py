@@ -0,0 +1,281 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import html
+import sqlite3
+import logging
+from threading import Lock
+
+from .formats import FORMATS, read_record, split_part
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Catalog database in the records folder
+CATALOG_FILE = "catalog.db"
+# Seconds between two commits
+CATALOG_COMMIT = 5
+# Version of the schema, a new version index again all records
+CATALOG_VERSION = 2
+# Maximum number of results of a search
+SEARCH_LIMIT = 10
+# Highlight marks in the snippets
+MARK_START, MARK_END = "\x02", "\x03"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    folder TEXT PRIMARY KEY,
+    chat_id INTEGER,
+    title TEXT
+);
+CREATE TABLE IF NOT EXISTS records (
+    folder TEXT,
+    record TEXT,
+    start INTEGER,
+    end INTEGER,
+    msgs INTEGER DEFAULT 0,
+    bytes INTEGER DEFAULT 0,
+    media INTEGER DEFAULT 0,
+    active INTEGER DEFAULT 0,
+    PRIMARY KEY (folder, record)
+);
+CREATE TABLE IF NOT EXISTS participants (
+    folder TEXT,
+    record TEXT,
+    user_id INTEGER,
+    firstname TEXT,
+    msgs INTEGER DEFAULT 0,
+    PRIMARY KEY (folder, record, user_id)
+);
+"""
+# Full text index of all messages
+SCHEMA_FTS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5 (
+    text, firstname UNINDEXED, folder UNINDEXED, record UNINDEXED, date UNINDEXED, msg_id UNINDEXED
+);
+"""
+# Without FTS5 the search is with LIKE
+SCHEMA_LIKE = """
+CREATE TABLE IF NOT EXISTS messages (
+    text TEXT, firstname TEXT, folder TEXT, record TEXT, date INTEGER, msg_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS messages_folder ON messages (folder);
+"""
+
+
+def is_record_file(file_name):
+    return any([file_name.endswith(f".{extension}") for extension in FORMATS.values()])
+
+
+def fts_query(text):
+    """ All words of the text, without the FTS5 syntax """
+    return " ".join(['"' + word.replace('"', '""') + '"' for word in text.split()])
+
+
+def like_snippet(text, query, size=60):
+    """ Part of the text around the first word of the query """
+    words = query.split()
+    idx = text.lower().find(words[0].lower()) if words else -1
+    if idx < 0:
+        return text[:size]
+    start = max(0, idx - size // 2)
+    end = idx + len(words[0])
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end + size // 2 < len(text) else ""
+    return prefix + text[start:idx] + MARK_START + text[idx:end] + MARK_END + text[end:end + size // 2] + suffix
+
+
+def highlight(snippet):
+    """ HTML snippet with the marks in bold """
+    return html.escape(snippet).replace(MARK_START, "<b>").replace(MARK_END, "</b>")
+
+
+class Catalog:
+    """ Index of all chats and records, updated for every message written.
+        The changes are committed by commit(), the queries always see them.
+    """
+
+    def __init__(self, records_folder):
+        self.records_folder = records_folder
+        self.lock = Lock()
+        self.db = sqlite3.connect(os.path.join(records_folder, CATALOG_FILE), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != CATALOG_VERSION:
+            self.db.executescript("DROP TABLE IF EXISTS records; DROP TABLE IF EXISTS participants; DROP TABLE IF EXISTS messages;")
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.executescript(SCHEMA_FTS)
+            self.fts = True
+        except sqlite3.OperationalError:
+            logger.warning("SQLite without FTS5, search with LIKE")
+            self.db.executescript(SCHEMA_LIKE)
+            self.fts = False
+        # First start or new schema, index all records on disk
+        if version != CATALOG_VERSION:
+            self.scan()
+            self.db.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+
+    def scan(self):
+        """ Index all records in the folder """
+        n_records = 0
+        with self.lock:
+            for folder in os.listdir(self.records_folder):
+                path = os.path.join(self.records_folder, folder)
+                if folder.startswith('.') or not os.path.isdir(path):
+                    continue
+                self.db.execute("INSERT OR IGNORE INTO chats (folder, chat_id) VALUES (?, ?)", (folder, int("-" + folder)))
+                for record in os.listdir(path):
+                    if os.path.isdir(os.path.join(path, record)):
+                        self.scan_record(folder, record)
+                        n_records += 1
+            self.db.commit()
+        logger.info(f"Catalog of {n_records} records")
+
+    def scan_record(self, folder, record):
+        path = os.path.join(self.records_folder, folder, record)
+        start = int(record) if record.isdigit() else None
+        self.db.execute("INSERT OR REPLACE INTO records (folder, record, start, end) VALUES (?, ?, ?, ?)", (folder, record, start, start))
+        for file_name in os.listdir(path):
+            file_path = os.path.join(path, file_name)
+            size = os.path.getsize(file_path)
+            if not is_record_file(file_name):
+                self.db.execute("UPDATE records SET media = media + 1, bytes = bytes + ? WHERE folder = ? AND record = ?", (size, folder, record))
+                continue
+            self.db.execute("UPDATE records SET bytes = bytes + ? WHERE folder = ? AND record = ?", (size, folder, record))
+            # The parts are read with the first file of the record
+            if split_part(file_name)[1]:
+                continue
+            try:
+                for msg in read_record(file_path):
+                    if 'landed' in msg:
+                        continue
+                    self.add_message(folder, record, msg, 0)
+            except Exception as e:
+                # A broken record never stops the scan
+                logger.warning(f"Record {file_path} not indexed: {e}")
+
+    def add_message(self, folder, record, msg, size):
+        date = int(msg['date'].timestamp())
+        self.db.execute("UPDATE records SET msgs = msgs + 1, bytes = bytes + ?, end = MAX(COALESCE(end, 0), ?) WHERE folder = ? AND record = ?",
+                        (size, date, folder, record))
+        if str(msg['user_id']).lstrip('-').isdigit():
+            self.db.execute("INSERT INTO participants (folder, record, user_id, firstname, msgs) VALUES (?, ?, ?, ?, 1) "
+                            "ON CONFLICT (folder, record, user_id) DO UPDATE SET msgs = msgs + 1, firstname = excluded.firstname",
+                            (folder, record, int(msg['user_id']), msg['firstname']))
+        if msg['text']:
+            self.db.execute("INSERT INTO messages (text, firstname, folder, record, date, msg_id) VALUES (?, ?, ?, ?, ?, ?)",
+                            (msg['text'], msg['firstname'], folder, record, date, msg['msg_id']))
+
+    def start(self, folder, record, chat_id, title=None):
+        with self.lock:
+            self.db.execute("INSERT INTO chats (folder, chat_id, title) VALUES (?, ?, ?) "
+                            "ON CONFLICT (folder) DO UPDATE SET title = COALESCE(excluded.title, title)", (folder, chat_id, title))
+            self.db.execute("INSERT OR IGNORE INTO records (folder, record, start, end, active) VALUES (?, ?, ?, ?, 1)",
+                            (folder, record, int(record), int(record)))
+            self.db.execute("UPDATE records SET active = 1 WHERE folder = ? AND record = ?", (folder, record))
+
+    def message(self, folder, record, msg, size):
+        with self.lock:
+            self.add_message(folder, record, msg, size)
+
+    def media(self, folder, record, size):
+        with self.lock:
+            self.db.execute("UPDATE records SET media = media + 1, bytes = bytes + ? WHERE folder = ? AND record = ?", (size, folder, record))
+
+    def stop(self, folder, record):
+        with self.lock:
+            self.db.execute("UPDATE records SET active = 0 WHERE folder = ? AND record = ?", (folder, record))
+            self.db.commit()
+
+    def remove(self, folder, record):
+        with self.lock:
+            self.db.execute("DELETE FROM records WHERE folder = ? AND record = ?", (folder, record))
+            self.db.execute("DELETE FROM participants WHERE folder = ? AND record = ?", (folder, record))
+            self.db.execute("DELETE FROM messages WHERE folder = ? AND record = ?", (folder, record))
+            self.db.commit()
+
+    def title(self, folder, title):
+        with self.lock:
+            self.db.execute("UPDATE chats SET title = ? WHERE folder = ?", (title, folder))
+
+    def chats(self, user_id=None):
+        """ All chats with records: [(folder, chat_id, title, participant)] """
+        with self.lock:
+            return self.db.execute(
+                "SELECT c.folder, c.chat_id, c.title, "
+                "EXISTS (SELECT 1 FROM participants p WHERE p.folder = c.folder AND p.user_id = ?) "
+                "FROM chats c WHERE EXISTS (SELECT 1 FROM records r WHERE r.folder = c.folder AND r.active = 0) ORDER BY c.title",
+                (user_id,)).fetchall()
+
+    def untitled(self):
+        with self.lock:
+            return self.db.execute("SELECT folder, chat_id FROM chats WHERE title IS NULL").fetchall()
+
+    def chat(self, folder):
+        with self.lock:
+            return self.db.execute("SELECT chat_id, title FROM chats WHERE folder = ?", (folder,)).fetchone()
+
+    def records(self, folder):
+        """ All records not active of a chat """
+        with self.lock:
+            return self.db.execute("SELECT record, start, end, msgs, bytes, media FROM records "
+                                   "WHERE folder = ? AND active = 0 ORDER BY record", (folder,)).fetchall()
+
+    def search(self, query, folders, limit=SEARCH_LIMIT):
+        """ Messages in the folders: [(folder, record, date, msg_id, firstname, snippet)] """
+        if not query.split() or not folders:
+            return []
+        scope = ", ".join(["?"] * len(folders))
+        with self.lock:
+            if self.fts:
+                rows = self.db.execute(
+                    f"SELECT folder, record, date, msg_id, firstname, snippet(messages, 0, ?, ?, '…', 12) FROM messages "
+                    f"WHERE messages MATCH ? AND folder IN ({scope}) ORDER BY rank LIMIT ?",
+                    [MARK_START, MARK_END, fts_query(query)] + list(folders) + [limit]).fetchall()
+                return rows
+            # All words in the text, as the FTS query
+            patterns = ["%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%" for word in query.split()]
+            words = " AND ".join(["text LIKE ? ESCAPE '\\'"] * len(patterns))
+            rows = self.db.execute(
+                f"SELECT folder, record, date, msg_id, firstname, text FROM messages "
+                f"WHERE {words} AND folder IN ({scope}) ORDER BY date DESC LIMIT ?",
+                patterns + list(folders) + [limit]).fetchall()
+        return [row[:5] + (like_snippet(row[5], query),) for row in rows]
+
+    def commit(self, context=None):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+# EOF
@@ -32,7 +32,11 @@ import json
 from uuid import uuid4
 import logging
 from functools import wraps
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, ConversationHandler, InlineQueryHandler
+from threading import Lock
+from time import monotonic
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, ConversationHandler, InlineQueryHandler, ChatMemberHandler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Bot, TelegramError
 from telegram import InlineQueryResultArticle, ParseMode, InputTextMessageContent, InlineQueryResultCachedPhoto, InlineQueryResultPhoto
 from telegram.utils.helpers import escape_markdown
@@ -40,9 +44,19 @@ from telegram.error import BadRequest
 
 # Menu 
 from .utils import build_menu, check_key_id, isAdmin, filter_channel, save_config, notify_group
+from .outbox import BULK
+from .cache import ChatCache, MemberCache, AdminCache, CHAT_TTL, MEMBER_TTL, ADMIN_TTL
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+# Max number of inline results for each answer
+INLINE_PAGE = 50
+# Default inline cache time in seconds
+INLINE_CACHE = 300
+# Number of parallel checks at startup
+CHECK_WORKERS = 8
+# Number of updates with a stored authorization
+AUTH_SIZE = 256
 
 
 def restricted(func):
@@ -94,13 +108,71 @@ class Channels:
         # Initialize channels if empty
         if 'channels' not in self.settings:
             self.settings['channels'] = {}
+        # Invite links registry
+        if 'links' not in self.settings:
+            self.settings['links'] = {}
         # Extract list of admins
         telegram = self.settings['telegram']
         self.LIST_OF_ADMINS = telegram['admins']
         # Allow chats
         self.groups = []
-        # Get the dispatcher to register handlers
-        dp = self.updater.dispatcher
+        # Shared chat metadata cache
+        cache = self.settings.get('config', {}).get('cache', {})
+        self.chats = ChatCache(ttl=int(cache.get('chats', CHAT_TTL)))
+        # Membership index
+        self.members = MemberCache(ttl=int(cache.get('members', MEMBER_TTL)))
+        # Administrators roster
+        self.admins = AdminCache(ttl=int(cache.get('admins', ADMIN_TTL)))
+        # Inline articles index
+        self.inline = None
+        self.inline_lock = Lock()
+        # Channels configuration at the last load
+        self.loaded = self.channels_config()
+        # Register handlers
+        self.add_handlers(self.updater.dispatcher)
+        # Refresh the administrators roster before it expires
+        self.refresh_job = self.updater.job_queue.run_repeating(self.refresh_admins, interval=self.admins.ttl // 2, first=1)
+        # Time to check all channels
+        self.check_time = None
+        # Authorization checks for the last updates
+        self.auth = OrderedDict()
+        self.auth_lock = Lock()
+        self.auth_saved = 0
+
+    def reload(self):
+        """ Apply the settings loaded again """
+        if 'channels' not in self.settings:
+            self.settings['channels'] = {}
+        if 'links' not in self.settings:
+            self.settings['links'] = {}
+        self.LIST_OF_ADMINS = self.settings['telegram']['admins']
+        # New timeouts and all chats loaded again
+        cache = self.settings.get('config', {}).get('cache', {})
+        self.chats.ttl = int(cache.get('chats', CHAT_TTL))
+        self.members.ttl = int(cache.get('members', MEMBER_TTL))
+        admins_ttl = int(cache.get('admins', ADMIN_TTL))
+        # Refresh the roster with the new timeout
+        if admins_ttl != self.admins.ttl:
+            self.admins.ttl = admins_ttl
+            self.refresh_job.schedule_removal()
+            self.refresh_job = self.updater.job_queue.run_repeating(self.refresh_admins, interval=self.admins.ttl // 2, first=1)
+        # Drop only the chats with a new configuration
+        loaded, self.loaded = self.loaded, self.channels_config()
+        changed = [chat_id for chat_id in set(loaded['channels']) | set(self.loaded['channels']) | set(loaded['links']) | set(self.loaded['links'])
+                   if any(loaded[key].get(chat_id) != self.loaded[key].get(chat_id) for key in ['channels', 'links'])]
+        for chat_id in changed:
+            self.chats.invalidate(chat_id)
+            self.members.invalidate(chat_id)
+            self.admins.invalidate(chat_id)
+        if changed:
+            self.invalidate_inline()
+        logger.info(f"Reload {len(changed)} channels changed")
+
+    def channels_config(self):
+        # A copy of the channels and links in settings
+        return json.loads(json.dumps({'channels': self.settings['channels'], 'links': self.settings['links']}))
+
+    def add_handlers(self, dp):
         #Setup handlers
         dp.add_handler(CommandHandler("channels", self.cmd_channels))
         dp.add_handler(CommandHandler("settings", self.ch_list))
@@ -116,15 +188,105 @@ class Channels:
         dp.add_handler(CallbackQueryHandler(self.ch_cancel, pattern='CH_CANCEL'))
         # on noncommand i.e message - echo the message on Telegram
         dp.add_handler(InlineQueryHandler(self.inlinequery))
-        # Check channels
-        for chat_id in list(self.settings['channels'].keys()):
-            try:
-                chat = self.updater.bot.getChat(chat_id)
-                logger.info(f"Load {chat_id} from list: {chat.title}")
-            except BadRequest:
-                del self.settings['channels'][chat_id]
-                logger.warning(f"This channel {chat_id} does not exist!")
-                notify_group(self.updater.bot, self.LIST_OF_ADMINS, f"This channel *{chat_id}* does not exist!")
+        # Invalidate cached chats when they change
+        chat_changed = Filters.status_update.new_chat_title | Filters.status_update.new_chat_photo | Filters.status_update.migrate
+        dp.add_handler(MessageHandler(chat_changed, self.chat_changed), group=-1)
+        # Keep the membership index updated
+        members_changed = Filters.status_update.new_chat_members | Filters.status_update.left_chat_member
+        dp.add_handler(MessageHandler(members_changed, self.members_changed), group=-1)
+        dp.add_handler(ChatMemberHandler(self.chat_member, ChatMemberHandler.ANY_CHAT_MEMBER), group=-1)
+
+    def check_channel(self, bot, chat_id):
+        try:
+            chat = self.getChat(bot, chat_id)
+            logger.info(f"Load {chat_id} from list: {chat.title}")
+        except BadRequest:
+            logger.warning(f"This channel {chat_id} does not exist!")
+            return chat_id
+        except TelegramError as e:
+            # Keep the channel, it will be checked on the next start
+            logger.warning(f"Channel {chat_id} not checked: {e}")
+        return None
+
+    def check_channels(self, bot):
+        """ Check all channels in parallel, run after the bot is started """
+        start = monotonic()
+        workers = int(self.settings.get('config', {}).get('workers', CHECK_WORKERS))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            missing = [chat_id for chat_id in executor.map(lambda chat_id: self.check_channel(bot, chat_id), list(self.settings['channels'].keys()))
+                       if chat_id is not None]
+        # Remove all missing channels from the job queue, never while a handler reads the channels
+        if missing:
+            self.updater.job_queue.run_once(lambda context: self.remove_channels(context.bot, missing), 0)
+        self.check_time = monotonic() - start
+        logger.info(f"Checked {len(self.settings['channels'])} channels in {self.check_time:.2f}s")
+
+    def remove_channels(self, bot, missing):
+        # A new dict, the handlers in progress keep iterating the old one
+        self.settings['channels'] = {chat_id: data for chat_id, data in self.settings['channels'].items() if chat_id not in missing}
+        save_config(self.settings_file, self.settings)
+        self.invalidate_inline()
+        text = "These channels do not exist:\n" + "\n".join([f" - *{chat_id}*" for chat_id in missing])
+        notify_group(bot, self.LIST_OF_ADMINS, text)
+
+    def getChat(self, bot, chat_id):
+        return self.chats.get(bot, chat_id)
+
+    def stats(self):
+        text = "<b>Channels:</b>\n"
+        if self.check_time is not None:
+            text += f" - checked in {self.check_time:.2f}s\n"
+        for name, cache in [('chats', self.chats), ('members', self.members), ('admins', self.admins)]:
+            values = ", ".join([f"{k}={v}" for k, v in cache.stats().items()])
+            text += f" - {name}: {values}\n"
+        text += f" - authorization API calls saved: {self.auth_saved}\n"
+        return text
+
+    def chat_changed(self, update, context):
+        message = update.effective_message
+        self.chats.invalidate(update.effective_chat.id)
+        self.invalidate_inline()
+        # The group is now a supergroup with a new id
+        if message.migrate_to_chat_id:
+            self.chats.invalidate(message.migrate_to_chat_id)
+
+    def members_changed(self, update, context):
+        chat_id = update.effective_chat.id
+        message = update.effective_message
+        for member in message.new_chat_members:
+            self.members.update(chat_id, member.id, 'member')
+        if message.left_chat_member:
+            self.members.update(chat_id, message.left_chat_member.id, 'left')
+
+    def chat_member(self, update, context):
+        # Member of the chat or the bot itself
+        member_update = update.chat_member if update.chat_member else update.my_chat_member
+        chat_id = member_update.chat.id
+        member = member_update.new_chat_member
+        self.members.update(chat_id, member.user.id, member.status)
+        self.admins.update(chat_id, member.user.id, member.status)
+
+    def refresh_admins(self, context):
+        self.admins.refresh(context.bot, list(self.settings['channels'].keys()))
+
+    def getLink(self, context, chat_id):
+        """ Read the invite link from the registry, never export a new link """
+        link = self.settings['links'].get(str(chat_id), None)
+        if link is None:
+            # Use the primary link if already available
+            link = self.getChat(context.bot, chat_id).invite_link
+            if link is not None:
+                # Saved with the next change of the channels
+                self.setLink(chat_id, link, save=False)
+        return link
+
+    def setLink(self, chat_id, link, save=True):
+        self.settings['links'][str(chat_id)] = link
+        if save:
+            save_config(self.settings_file, self.settings)
+
+    def isBotAdmin(self, context, chat_id):
+        return isAdmin(None, context, context.bot.id, chat_id=chat_id, roster=self.admins)
 
     def register_chat(self, update, context):
         type_chat = update.effective_chat.type
@@ -133,30 +295,58 @@ class Channels:
             if chat_id not in self.groups and str(chat_id) not in self.settings['channels']:
                 self.groups += [chat_id]
 
+    def authorization(self, update, name, check, calls):
+        """ Run a check only once for each update and share the result
+            with all decorators and handlers of the same update.
+            calls is the number of API calls required without this context
+        """
+        key = (update.update_id, name)
+        with self.auth_lock:
+            if key in self.auth:
+                self.auth_saved += calls
+                return self.auth[key]
+        value = check()
+        with self.auth_lock:
+            self.auth[key] = value
+            # Drop the oldest updates
+            while len(self.auth) > AUTH_SIZE:
+                self.auth.popitem(last=False)
+        return value
+
     def isRestricted(self, update, context):
         if update.effective_user.id in self.LIST_OF_ADMINS:
             return False
+        n_admin = len([data for data in self.settings['channels'].values() if data.get('admin', False)])
+        return self.authorization(update, 'restricted', lambda: self._isRestricted(update, context), n_admin)
+
+    def _isRestricted(self, update, context):
+        user_id = update.effective_user.id
         for chat_id in self.settings['channels']:
-            username = update.message.from_user.username
             if self.settings['channels'][chat_id].get('admin', False):
-                if isAdmin(update, context, username, chat_id=int(chat_id)):
+                if isAdmin(update, context, user_id, chat_id=int(chat_id), roster=self.admins):
                     return False
         return True
 
     def isAdmin(self, update, context):
         if update.effective_user.id in self.LIST_OF_ADMINS:
             return True
+        return self.authorization(update, 'admin', lambda: self._isAdmin(update, context), len(self.settings['channels']))
+
+    def _isAdmin(self, update, context):
+        user_id = update.effective_user.id
         for chat_id in self.settings['channels']:
-            username = update.message.from_user.username
-            if isAdmin(update, context, username, chat_id=int(chat_id)):
+            if isAdmin(update, context, user_id, chat_id=int(chat_id), roster=self.admins):
                 return True
         return False
 
     def isAllowed(self, update, context):
+        return self.authorization(update, 'allowed', lambda: self._isAllowed(update, context), len(self.settings['channels']) + 1)
+
+    def _isAllowed(self, update, context):
         type_chat = []
-        chat = context.bot.getChat(update.effective_chat.id)
-        if chat.type == 'private':
-            type_chat += [chat.type]
+        # Type of chat is already in the update
+        if update.effective_chat.type == 'private':
+            type_chat += ['private']
         if str(update.effective_chat.id) in self.settings['channels']:
             type_chat += ['channel']
             if self.settings['channels'][str(update.effective_chat.id)].get('admin', False):
@@ -168,100 +358,105 @@ class Channels:
     def isMember(self, context, user_id):
         chat_member = []
         for chat_id in self.settings['channels']:
-            try:
-                chat = context.bot.get_chat_member(chat_id, user_id)
-                if chat.status not in ['left', 'kicked']:
-                    chat_member +=[int(chat_id)]
-            except TelegramError:
-                pass
+            if self.members.isMember(context.bot, chat_id, user_id):
+                chat_member += [int(chat_id)]
         return chat_member
 
     def getLevel(self, context, user_id):
         level = 0
         for chat_id in self.settings['channels']:
-            try:
-                _ = context.bot.get_chat_member(chat_id, int(user_id))
+            # Skip chats where the user is not available
+            if self.members.status(context.bot, chat_id, user_id) is not None:
                 level_ch = int(self.settings['channels'][chat_id].get('type', "0"))
                 level = level_ch if level_ch <= level else level
-            except TelegramError:
-                pass
         return level
 
+    def build_inline(self, context):
+        """ Make all inline articles, sorted by title """
+        entries = []
+        for chat_id, data in self.settings['channels'].items():
+            chat = self.getChat(context.bot, chat_id)
+            link = self.getLink(context, chat_id)
+            level = int(data.get('type', "0"))
+            if link is None:
+                continue
+            # Load icon type channel
+            icon_string = self.getIcons(context, chat_id)
+            # Check if this group can see other group with same level
+            button = [InlineKeyboardButton(icon_string + chat.title, url=link)]
+            # Does not work !!!
+            #if chat.photo:
+            #    file_id = chat.photo.small_file_id
+            #    newFile = context.bot.getFile(file_id)
+            #    thumb_url = newFile.file_path
+            #    articles += [InlineQueryResultCachedPhoto(id=uuid4(), title=chat.title, photo_file_id=file_id)
+            thumb_url = None
+            text = f"*{chat.title}*"
+            if chat.description:
+                text += f"\n{chat.description}"
+            # https://github.com/python-telegram-bot/python-telegram-bot/blob/master/telegram/inline/inlinequeryresultarticle.py
+            article = InlineQueryResultArticle(id=str(chat_id), title=icon_string + chat.title,
+                                               input_message_content=InputTextMessageContent(text, parse_mode='Markdown'),
+                                               url=link,
+                                               thumb_url=thumb_url,
+                                               description=chat.description,
+                                               reply_markup=InlineKeyboardMarkup(build_menu(button, 1)))
+            entries += [(chat.title.lower(), level, article)]
+        entries.sort(key=lambda entry: entry[0])
+        # Articles visible from each level
+        return {int(level): [entry for entry in entries if entry[1] >= int(level)] for level in Channels.TYPE}
+
     def inlinequery(self, update, context):
         """Handle the inline query."""
-        query = update.inline_query.query
+        query = update.inline_query.query.lower()
+        offset = int(update.inline_query.offset) if update.inline_query.offset.isdigit() else 0
         # extract level user
         local_chat_id = str(update.effective_user.id)
         local_level = self.getLevel(context, local_chat_id)
-        # Sort channels
-        channels = sorted(self.settings['channels'].items(), key=lambda kv:(context.bot.getChat(kv[0]).title, kv[1]))
-        # If there is a query filter the channels
-        if query:
-            filtered_dict = [(k,v) for (k,v) in channels if query.lower() in context.bot.getChat(k).title.lower()]
-        else:
-            filtered_dict = channels
         # Minimum configuration level
         min_level = int(self.settings['config'].get('inline', '-10'))
-        # Make articles list
-        articles = []
-        for chat_id, data in filtered_dict:
-            chat = context.bot.getChat(chat_id)
-            link = chat.invite_link
-            level = int(data.get('type', "0"))
-            # Update link
-            if isAdmin(update, context, context.bot.username, chat_id=chat_id):
-                # If None generate a link
-                if link is None:
-                    link = context.bot.exportChatInviteLink(chat_id)
-            # Show only enable channels
-            if local_level <= level and level >= min_level and link is not None:
-                # Load icon type channel
-                icon_string = self.getIcons(context, chat_id)
-                # Check if this group can see other group with same level
-                button = [InlineKeyboardButton(icon_string + chat.title, url=link)]
-                # Does not work !!!
-                #if chat.photo:
-                #    file_id = chat.photo.small_file_id
-                #    newFile = context.bot.getFile(file_id)
-                #    thumb_url = newFile.file_path
-                #    articles += [InlineQueryResultCachedPhoto(id=uuid4(), title=chat.title, photo_file_id=file_id)
-                thumb_url = None
-                text = f"*{chat.title}*"
-                if chat.description:
-                    text += f"\n{chat.description}"
-                # https://github.com/python-telegram-bot/python-telegram-bot/blob/master/telegram/inline/inlinequeryresultarticle.py
-                articles += [InlineQueryResultArticle(id=uuid4(), title=icon_string + chat.title,
-                                                      input_message_content=InputTextMessageContent(text, parse_mode='Markdown'),
-                                                      url=link,
-                                                      thumb_url=thumb_url,
-                                                      description=chat.description,
-                                                      reply_markup=InlineKeyboardMarkup(build_menu(button, 1)))]
+        # Build the index only after a change or when the chats are expired
+        with self.inline_lock:
+            if self.inline is None or monotonic() - self.inline[0] > self.chats.ttl:
+                self.inline = (monotonic(), self.build_inline(context))
+                logger.info("Inline index built")
+            _, index = self.inline
+        # Show only enable channels
+        entries = index[max(local_level, min_level)]
+        # If there is a query filter the channels, titles that starts with the query first
+        if query:
+            entries = [entry for entry in entries if entry[0].startswith(query)] + \
+                      [entry for entry in entries if query in entry[0] and not entry[0].startswith(query)]
+        articles = [article for _, _, article in entries[offset:offset + INLINE_PAGE]]
+        next_offset = str(offset + INLINE_PAGE) if len(entries) > offset + INLINE_PAGE else ''
         # Update inline query
-        update.inline_query.answer(articles, cache_time=10)
+        cache_time = int(self.settings['config'].get('inline_cache', INLINE_CACHE))
+        update.inline_query.answer(articles, cache_time=cache_time, is_personal=True, next_offset=next_offset)
+
+    def invalidate_inline(self):
+        with self.inline_lock:
+            self.inline = None
 
     def getChannels(self, update, context):
         buttons = []
         local_chat_id = str(update.effective_chat.id)
         if local_chat_id in self.settings['channels']:
-            local_chat = context.bot.getChat(local_chat_id)
+            local_chat = self.getChat(context.bot, local_chat_id)
             local_level = int(self.settings['channels'][local_chat_id].get('type', "0"))
             logger.debug(f"{local_chat.title} = {local_level}")
         else:
             local_level = self.getLevel(context, local_chat_id)
         # Sort channels
-        channels = sorted(self.settings['channels'].items(), key=lambda kv:(context.bot.getChat(kv[0]).title, kv[1]))
+        channels = sorted(self.settings['channels'].items(), key=lambda kv:(self.getChat(context.bot, kv[0]).title, kv[1]))
         for chat_id, data in channels:
-            chat = context.bot.getChat(chat_id)
+            chat = self.getChat(context.bot, chat_id)
             name = chat.title
-            link = chat.invite_link
+            link = self.getLink(context, chat_id)
             level = int(data.get('type', "0"))
-            if isAdmin(update, context, context.bot.username, chat_id=chat_id):
-                # If None generate a link
-                if link is None:
-                    link = context.bot.exportChatInviteLink(chat_id)
+            bot_admin = self.isBotAdmin(context, chat_id)
             # Make flag lang
             # slang = flag(channel.get('lang', 'ita'))
-            is_admin = ' (Bot not Admin)' if not isAdmin(update, context, context.bot.username, chat_id=chat_id) else ''
+            is_admin = ' (Bot not Admin)' if not bot_admin else ''
             # Load icon type channel
             icon_string = self.getIcons(context, chat_id)
             # Check if this group can see other group with same level
@@ -280,7 +475,7 @@ class Channels:
         context.bot.send_message(chat_id=update.effective_chat.id, text=message, parse_mode='HTML', reply_markup=reply_markup)
 
     def getIcons(self, context, chat_id):
-        chat = context.bot.getChat(chat_id)
+        chat = self.getChat(context.bot, chat_id)
         level = self.settings['channels'][chat_id].get('type', "0")
         admin = self.settings['channels'][chat_id].get('admin', False)
         records = self.settings['channels'][chat_id].get('records', True)
@@ -300,19 +495,19 @@ class Channels:
     def get_channels_name(self, context):
         bot = context.bot
         # Sort channels
-        channels = sorted(self.settings['channels'].items(), key=lambda kv:(bot.getChat(kv[0]).title, kv[1]))
+        channels = sorted(self.settings['channels'].items(), key=lambda kv:(self.getChat(bot, kv[0]).title, kv[1]))
         if not channels:
             return "<b>No channels</b>"
         text = "<b>Channels:</b>\n"
         for chat_id, _ in channels:
-            chat = bot.getChat(chat_id)
+            chat = self.getChat(bot, chat_id)
             # Load icon type channel
             icon_string = self.getIcons(context, chat_id)
             text += f" - {icon_string} {chat.title}\n" if icon_string else f" - {chat.title}\n"
         if self.groups:
             text += "<b>New groups:</b>\n"
         for chat_id in self.groups:
-            chat = context.bot.getChat(chat_id)
+            chat = self.getChat(context.bot, chat_id)
             isChannel = '[📢] ' if chat.type == 'channel' else ''
             text += f" - {isChannel}{chat.title}\n"
         return text
@@ -326,15 +521,15 @@ class Channels:
         # Extract chat id
         buttons = []
         # Sort channels
-        channels = sorted(self.settings['channels'].items(), key=lambda kv:(context.bot.getChat(kv[0]).title, kv[1]))
+        channels = sorted(self.settings['channels'].items(), key=lambda kv:(self.getChat(context.bot, kv[0]).title, kv[1]))
         for chat_id, _ in channels:
-            chat = context.bot.getChat(chat_id)
+            chat = self.getChat(context.bot, chat_id)
             title = chat.title
             # Load icon type channel
             icon_string = self.getIcons(context, chat_id)
             buttons += [InlineKeyboardButton(icon_string + title, callback_data=f"CH_EDIT {keyID} id={chat_id}")]
         for chat_id in self.groups:
-            chat = context.bot.getChat(chat_id)
+            chat = self.getChat(context.bot, chat_id)
             title = chat.title
             isChannel = '📢' if chat.type == 'channel' else ''
             buttons += [InlineKeyboardButton(f"[{isChannel}NEW!] " + title, callback_data=f"CH_EDIT {keyID} id={chat_id}")]
@@ -370,7 +565,7 @@ class Channels:
             context.user_data[keyID][name] = value
         # Read chat_id
         chat_id = context.user_data[keyID]['id']
-        chat = context.bot.getChat(chat_id)
+        chat = self.getChat(context.bot, chat_id)
         # Populate configuration
         if chat_id in self.settings['channels']:
             for k, v in self.settings['channels'][chat_id].items():
@@ -395,7 +590,8 @@ class Channels:
         # Make message
         text = f"<b>{chat.title}</b>\n"
         text += f" - <b>ID:</b> {chat_id}\n"
-        link = chat.invite_link if chat.invite_link is not None else "not available"
+        link = self.getLink(context, chat_id)
+        link = link if link is not None else "not available"
         text += f" - <b>Link:</b> {link}\n"
         # for k, v in context.user_data[keyID].items():
         #    if k == 'type':
@@ -410,12 +606,16 @@ class Channels:
         # Extract keyID, chat_id
         keyID = data[1]
         chat_id = context.user_data[keyID]['id']
-        chat = context.bot.getChat(chat_id)
+        chat = self.getChat(context.bot, chat_id)
         # remove key from user_data list
         del context.user_data[keyID]
         # generate chat link
-        if isAdmin(update, context, context.bot.username, chat_id=chat_id):
+        if self.isBotAdmin(context, chat_id):
             link = context.bot.exportChatInviteLink(chat_id)
+            # Old link is revoked
+            self.setLink(chat_id, link)
+            self.chats.invalidate(chat_id)
+            self.invalidate_inline()
             # edit message
             query.edit_message_text(text=f"{chat.title} Link generated:\n{link}")
         else:
@@ -429,7 +629,7 @@ class Channels:
         # Extract keyID, chat_id and title
         keyID = data[1]
         chat_id = context.user_data[keyID]['id']
-        title = context.bot.getChat(chat_id).title
+        title = self.getChat(context.bot, chat_id).title
         # Make buttons
         buttons = []
         if 'type' in context.user_data[keyID]:
@@ -448,24 +648,24 @@ class Channels:
         query.edit_message_text(text=f"{title}", reply_markup=reply_markup)
 
     def notifyNewChat(self, update, context, chat_id):
-        chat = context.bot.getChat(chat_id)
+        chat = self.getChat(context.bot, chat_id)
         name = chat.title
-        link = chat.invite_link
+        link = self.getLink(context, chat_id)
         level = int(self.settings['channels'][chat_id].get('type', "0")) if chat_id in self.settings['channels'] else 0
 
         for l_chat_id in self.settings['channels']:
             l_level = int(self.settings['channels'][l_chat_id].get('type', "0"))
-            l_chat = context.bot.getChat(l_chat_id)
+            l_chat = self.getChat(context.bot, l_chat_id)
             # Check if this group can see other group with same level
             logger.info(f"level {chat.title}={level}, {l_chat_id}={l_level}")
             if l_chat_id == str(chat_id):
                 # Send local message only if not a channel
                 if l_chat.type != 'channel':
-                    context.bot.send_message(chat_id=l_chat_id, text=f"Hi! I'm activate")
+                    context.bot.send_message(chat_id=l_chat_id, text=f"Hi! I'm activate", priority=BULK)
             else:
                 if l_level <= level and link is not None:
                     reply_markup = InlineKeyboardMarkup(build_menu([InlineKeyboardButton(name, url=link)], 1))
-                    context.bot.send_message(chat_id=l_chat_id, text=f"New channel:", reply_markup=reply_markup)
+                    context.bot.send_message(chat_id=l_chat_id, text=f"New channel:", reply_markup=reply_markup, priority=BULK)
 
     @check_key_id('Error message')
     def ch_notify(self, update, context):
@@ -474,7 +674,7 @@ class Channels:
         # Extract keyID, chat_id
         keyID = data[1]
         chat_id = context.user_data[keyID]['id']
-        chat = context.bot.getChat(chat_id)
+        chat = self.getChat(context.bot, chat_id)
         if len(data) > 2:
             if data[2] == 'True':
                 # Notify new chat in all chats
@@ -496,7 +696,7 @@ class Channels:
         # Extract keyID, chat_id and title
         keyID = data[1]
         chat_id = context.user_data[keyID]['id']
-        chat = context.bot.getChat(chat_id)
+        chat = self.getChat(context.bot, chat_id)
         admin = context.user_data[keyID].get('admin', False)
         buttons = [InlineKeyboardButton("✅ Yes " + ("[X]" if admin else ""),
                                         callback_data=f"CH_EDIT {keyID} admin=True"),
@@ -512,7 +712,7 @@ class Channels:
         # Extract keyID, chat_id and title
         keyID = data[1]
         chat_id = context.user_data[keyID]['id']
-        chat = context.bot.getChat(chat_id)
+        chat = self.getChat(context.bot, chat_id)
         beta = context.user_data[keyID].get('beta', False)
         buttons = [InlineKeyboardButton("✅ Yes " + ("[X]" if beta else ""),
                                         callback_data=f"CH_EDIT {keyID} beta=True"),
@@ -528,7 +728,7 @@ class Channels:
         # Extract keyID, chat_id and title
         keyID = data[1]
         chat_id = context.user_data[keyID]['id']
-        chat = context.bot.getChat(chat_id)
+        chat = self.getChat(context.bot, chat_id)
         records = context.user_data[keyID].get('records', True)
         buttons = [InlineKeyboardButton("✅ Yes " + ("[X]" if records else ""),
                                         callback_data=f"CH_EDIT {keyID} records=True"),
@@ -545,12 +745,12 @@ class Channels:
         # Extract keyID, chat_id
         keyID = data[1]
         chat_id = context.user_data[keyID]['id']
-        chat = context.bot.getChat(chat_id)
-        # generate chat link
-        if isAdmin(update, context, context.bot.username, chat_id=chat_id):
+        chat = self.getChat(context.bot, chat_id)
+        # generate chat link only the first time
+        if self.isBotAdmin(context, chat_id):
             # If None generate a link
-            if chat.invite_link is None:
-                context.bot.exportChatInviteLink(chat_id)
+            if self.getLink(context, chat_id) is None:
+                self.setLink(chat_id, context.bot.exportChatInviteLink(chat_id))
         # Add channel in list
         if str(chat_id) not in self.settings['channels']:
             self.settings['channels'][str(chat_id)] = {}
@@ -575,6 +775,7 @@ class Channels:
             self.groups.remove(int(chat_id))
         # Save to CSV file
         save_config(self.settings_file, self.settings)
+        self.invalidate_inline()
         # Make message
         text = f"<b>Stored</b>\n"
         # get messages
@@ -582,7 +783,8 @@ class Channels:
         # Make text
         text += f"<b>{chat.title}</b>\n"
         text += f" - <b>ID:</b> {chat_id}\n"
-        link = chat.invite_link if chat.invite_link is not None else "not available"
+        link = self.getLink(context, chat_id)
+        link = link if link is not None else "not available"
         text += f" - <b>Link:</b> {link}\n"
         for value in messages.values():
             text += f" - {value}\n"
@@ -598,10 +800,16 @@ class Channels:
         # Extract keyID, chat_id
         keyID = data[1]
         chat_id = context.user_data[keyID]['id']
-        chat = context.bot.getChat(chat_id)
+        chat = self.getChat(context.bot, chat_id)
         # Update channel setting
         if str(chat_id) in self.settings['channels']:
             del self.settings['channels'][str(chat_id)]
+        self.chats.invalidate(chat_id)
+        self.members.invalidate(chat_id)
+        self.admins.invalidate(chat_id)
+        self.invalidate_inline()
+        # Remove link from registry
+        link = self.settings['links'].pop(str(chat_id), None)
         # Remove chat_id if in groups list
         if chat_id in self.groups:
             # Remove from groups list
@@ -610,7 +818,7 @@ class Channels:
         text = f"<b>Removed</b>\n"
         text += f"<b>{chat.title}</b>\n"
         text += f" - <b>ID:</b> {chat_id}\n"
-        link = chat.invite_link if chat.invite_link is not None else "not available"
+        link = link if link is not None else "not available"
         text += f" - <b>Link:</b> {link}\n"
         query.edit_message_text(text=text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
         # remove key from user_data list
@@ -625,13 +833,14 @@ class Channels:
         text = f"<b>Abort</b>\n"
         if len(data) > 2:
             chat_id = data[2]
-            chat = context.bot.getChat(chat_id)
+            chat = self.getChat(context.bot, chat_id)
             # get messages
             messages = self.get_channels_config(context, keyID)
             # Make text
             text += f"<b>{chat.title}</b>\n"
             text += f" - <b>ID:</b> {chat_id}\n"
-            link = chat.invite_link if chat.invite_link is not None else "not available"
+            link = self.getLink(context, chat_id)
+            link = link if link is not None else "not available"
             text += f" - <b>Link:</b> {link}\n"
             for value in messages.values():
                 text += f" - {value}\n"
@@ -54,8 +54,14 @@ class Config:
         # Initialize config if empty
         if 'config' not in self.settings:
             self.settings['config'] = {}
-        # Get the dispatcher to register handlers
-        dp = self.updater.dispatcher
+        # Register handlers
+        self.add_handlers(self.updater.dispatcher)
+
+    def reload(self):
+        if 'config' not in self.settings:
+            self.settings['config'] = {}
+
+    def add_handlers(self, dp):
         # Configuration
         dp.add_handler(CommandHandler("config", self.config))
         dp.add_handler(CallbackQueryHandler(self.config_save, pattern='C_SAVE'))
@@ -74,7 +80,7 @@ class Config:
         message = [("🔊" if self.settings['config'].get('notify', True) else "🔇") + " Notifications"]
         def_ch = self.settings['config'].get('dch', None)
         if def_ch is not None:
-            def_ch = context.bot.getChat(def_ch).title
+            def_ch = self.channels.getChat(context.bot, def_ch).title
         else:
             def_ch = "None"
         message += ["📢 Default channel: " + def_ch]
@@ -207,7 +213,7 @@ class Config:
         buttons = []
         def_ch = self.settings['config'].get('dch', None)
         for chat_id in self.settings['channels']:
-            chat = context.bot.getChat(chat_id)
+            chat = self.channels.getChat(context.bot, chat_id)
             if chat.type == 'channel':
                 icons = self.channels.getIcons(context, chat_id)
                 isSelected = " [X]" if def_ch == chat_id else ""
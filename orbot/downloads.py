@@ -0,0 +1,208 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import json
+import shutil
+import logging
+from hashlib import sha1
+from time import sleep, monotonic
+from queue import Queue
+from threading import Thread, Lock
+from telegram.error import NetworkError, TelegramError
+
+from .utils import save_config
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Downloads in progress
+DOWNLOADS_FILE = "downloads.json"
+# Files not complete, out of the record folders
+PARTS_FOLDER = ".downloads"
+# Number of parallel downloads
+DOWNLOAD_WORKERS = 4
+# Number of attempts for each file
+DOWNLOAD_RETRY = 3
+# Bots can download files up to 20MB
+# https://core.telegram.org/bots/api#getfile
+DOWNLOAD_SIZE = 20 * 1024 * 1024
+# Bytes for second of all downloads, 0 without limit
+DOWNLOAD_BUDGET = 0
+
+
+class DownloadPool:
+    """ Download all files of the records with a fixed number of workers.
+        The queue is stored and restored at the next start,
+        a file is downloaded in the parts folder and moved in its path only when is complete.
+    """
+
+    def __init__(self, bot, queue_file, landed=None, store=None, workers=DOWNLOAD_WORKERS, retry=DOWNLOAD_RETRY,
+                 size=DOWNLOAD_SIZE, budget=DOWNLOAD_BUDGET):
+        self.bot = bot
+        self.queue_file = queue_file
+        # Parts left from the last run are downloaded again
+        self.parts = os.path.join(os.path.dirname(queue_file), PARTS_FOLDER)
+        shutil.rmtree(self.parts, ignore_errors=True)
+        os.makedirs(self.parts)
+        # Media store, the files are downloaded only once
+        self.store = store
+        # Function called with the task when a file is downloaded
+        self.landed = landed
+        self.retry = int(retry)
+        self.size = int(size)
+        self.budget = int(budget)
+        self.lock = Lock()
+        self.queue = Queue()
+        self.tasks = {}
+        # Time when the bandwidth budget is free
+        self.free = monotonic()
+        # Statistics
+        self.n_done = 0
+        self.n_failed = 0
+        self.n_dedupe = 0
+        self.n_bytes = 0
+        # Restore all downloads
+        if os.path.isfile(self.queue_file):
+            try:
+                with open(self.queue_file) as stream:
+                    self.tasks = json.load(stream)
+                logger.info(f"Restore {len(self.tasks)} downloads")
+            except ValueError as e:
+                # Written from an old version without the atomic save
+                logger.error(f"Downloads not restored, {self.queue_file} is not valid: {e}")
+        for key in self.tasks:
+            self.queue.put(key)
+        self.workers = [Thread(target=self.run, name=f"download-{idx}", daemon=True) for idx in range(int(workers))]
+        for worker in self.workers:
+            worker.start()
+
+    def add(self, file_id, unique_id, path, size=None, record=None, msg_id=None):
+        """ Queue a file, return False if the file is too big or already in queue """
+        if size is not None and size > self.size:
+            logger.warning(f"File {path} too big {size} bytes")
+            with self.lock:
+                self.n_failed += 1
+            return False
+        key = f"{unique_id}:{path}"
+        task = {'file_id': file_id, 'unique_id': unique_id, 'path': path,
+                'size': size, 'record': record, 'msg_id': msg_id}
+        with self.lock:
+            if key in self.tasks or os.path.isfile(path):
+                self.n_dedupe += 1
+                return False
+        # Already downloaded for another record
+        if self.store is not None and self.store.link(unique_id, path):
+            with self.lock:
+                self.n_dedupe += 1
+            self.land(task, os.path.getsize(path))
+            return False
+        with self.lock:
+            self.tasks[key] = task
+            save_config(self.queue_file, self.tasks)
+        self.queue.put(key)
+        return True
+
+    def land(self, task, size):
+        logger.info(f"Downloaded {task['path']}")
+        if self.landed is not None:
+            try:
+                self.landed(task, size)
+            except Exception:
+                logger.exception(f"Landed {task['path']}")
+
+    def wait_budget(self, size):
+        """ Wait the bandwidth budget for size bytes """
+        if not self.budget or not size:
+            return
+        with self.lock:
+            now = monotonic()
+            start = max(now, self.free)
+            self.free = start + size / self.budget
+        if start > now:
+            sleep(start - now)
+
+    def download(self, task):
+        """ Download a file with a temporary name, return the size """
+        for attempt in range(self.retry):
+            try:
+                newFile = self.bot.get_file(task['file_id'])
+                if newFile.file_size is not None and newFile.file_size > self.size:
+                    logger.warning(f"File {task['path']} too big {newFile.file_size} bytes")
+                    return None
+                self.wait_budget(newFile.file_size or task['size'])
+                part = os.path.join(self.parts, sha1(f"{task['unique_id']}:{task['path']}".encode()).hexdigest() + ".part")
+                newFile.download(custom_path=part)
+                if self.store is not None:
+                    self.store.put(task['unique_id'], part, task['path'])
+                else:
+                    os.replace(part, task['path'])
+                return os.path.getsize(task['path'])
+            except NetworkError as e:
+                logger.warning(f"Download {task['path']} retry {attempt + 1}: {e}")
+                sleep(2 ** attempt)
+            except (TelegramError, OSError) as e:
+                logger.error(f"Download {task['path']} failed: {e}")
+                return None
+        return None
+
+    def run(self):
+        while True:
+            key = self.queue.get()
+            if key is None:
+                break
+            task = self.tasks[key]
+            logger.info(f"Downloading... {task['path']}")
+            size = self.download(task)
+            with self.lock:
+                del self.tasks[key]
+                save_config(self.queue_file, self.tasks)
+                if size is None:
+                    self.n_failed += 1
+                else:
+                    self.n_done += 1
+                    self.n_bytes += size
+            if size is not None:
+                self.land(task, size)
+
+    def stats(self):
+        with self.lock:
+            return {'queue': len(self.tasks), 'done': self.n_done, 'failed': self.n_failed,
+                    'dedupe': self.n_dedupe, 'MB': round(self.n_bytes / 1024 / 1024, 1)}
+
+    def stop(self):
+        """ Finish the downloads in progress, the others are restored at the next start """
+        # The workers stop before the downloads left in queue
+        with self.queue.mutex:
+            self.queue.queue.clear()
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+# EOF
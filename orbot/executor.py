@@ -0,0 +1,97 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+from collections import deque
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Default number of workers
+CHAT_WORKERS = 8
+
+
+def update_key(update):
+    """ Updates with the same key are processed in order """
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+    return None
+
+
+class ChatExecutor:
+    """ Process the updates of different chats in parallel on a pool of workers,
+        the updates of the same chat are processed one at time and in order.
+    """
+
+    def __init__(self, dispatcher, workers=CHAT_WORKERS):
+        self.process_update = dispatcher.process_update
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat')
+        self.lanes = {}
+        self.lock = Lock()
+        # Route all updates from the dispatcher
+        dispatcher.process_update = self.submit
+
+    def submit(self, update):
+        key = update_key(update)
+        with self.lock:
+            # A worker is already running this chat
+            if key in self.lanes:
+                self.lanes[key].append(update)
+                return
+            self.lanes[key] = deque([update])
+        self.pool.submit(self.run, key)
+
+    def run(self, key):
+        while True:
+            with self.lock:
+                update = self.lanes[key][0]
+            try:
+                self.process_update(update)
+            except Exception:
+                logger.exception(f"Update not processed in {key}")
+            with self.lock:
+                lane = self.lanes[key]
+                lane.popleft()
+                if not lane:
+                    del self.lanes[key]
+                    return
+
+    def stats(self):
+        with self.lock:
+            return {'chats': len(self.lanes), 'pending': sum([len(lane) for lane in self.lanes.values()])}
+
+    def stop(self):
+        self.pool.shutdown(wait=True)
+# EOF
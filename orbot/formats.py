@@ -0,0 +1,190 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import os
+import re
+import gzip
+import zlib
+import json
+import logging
+from datetime import datetime, timezone
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Columns of the legacy format
+MSG_TEXT_ORDER = ['date', 'user_id', 'firstname', 'msg_id', 'edit', 'reply_id', 'forward_from', 'text']
+# Format: file extension
+FORMATS = {'tsv': 'csv',
+           'jsonl': 'jsonl',
+           'jsonl.gz': 'jsonl.gz',
+           'jsonl.zst': 'jsonl.zst'}
+# Default format of new records
+RECORD_FORMAT = 'jsonl.gz'
+TSV_SEPARATOR = "\t"
+# End of a compressed stream not closed, all lines flushed before are read
+TRUNCATED = (EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+# A record restored after a crash continues in a new file: <name>.<part>.<extension>
+PART = re.compile(r"^(.+)\.(\d+)\.(" + "|".join([re.escape(extension) for extension in FORMATS.values()]) + r")$")
+
+
+def record_format(name):
+    """ Check the format, zstd fallback on gzip if zstandard is not installed """
+    if name not in FORMATS:
+        raise ValueError(f"Record format {name} not in {list(FORMATS)}")
+    if name == 'jsonl.zst' and zstandard is None:
+        logger.warning("zstandard is not installed, records in jsonl.gz")
+        return 'jsonl.gz'
+    return name
+
+
+def path_format(path):
+    """ Format from the file name """
+    for name, extension in FORMATS.items():
+        if path.endswith(f".{extension}"):
+            return name
+    return 'tsv'
+
+
+def open_record(path, mode='a', buffering=-1):
+    """ Open a record as text stream, compressed by extension.
+        All append add a new gzip member or zstd frame, the reader reads all of them.
+    """
+    name = path_format(path)
+    if name == 'jsonl.gz':
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    if name == 'jsonl.zst':
+        if 'r' in mode:
+            stream = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(open(path, mode + 'b'), closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(path, mode, buffering=buffering, encoding='utf-8')
+
+
+def header(name):
+    if name == 'tsv':
+        return TSV_SEPARATOR.join(MSG_TEXT_ORDER) + "\n"
+    return ""
+
+
+def encode(name, msg):
+    """ A message in a line """
+    if name == 'tsv':
+        return TSV_SEPARATOR.join([str(msg[key]) for key in MSG_TEXT_ORDER]) + "\n"
+    data = dict(msg)
+    if isinstance(data['date'], datetime):
+        data['date'] = int(data['date'].timestamp())
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')) + "\n"
+
+
+def split_part(file_name):
+    """ Name of the first file and number of the part of a record file """
+    match = PART.match(file_name)
+    if match is None:
+        return file_name, 0
+    return f"{match.group(1)}.{match.group(3)}", int(match.group(2))
+
+
+def record_parts(path):
+    """ All files of a record in order, the first and the parts after a crash """
+    folder, file_name = os.path.split(path)
+    file_name, _ = split_part(file_name)
+    parts = []
+    for other in os.listdir(folder) if os.path.isdir(folder) else []:
+        base, part = split_part(other)
+        if base == file_name:
+            parts += [(part, os.path.join(folder, other))]
+    return [part_path for _, part_path in sorted(parts)]
+
+
+def next_part(path):
+    """ Path of a new part of a record, never a file already written """
+    parts = record_parts(path)
+    folder, file_name = os.path.split(path)
+    file_name, _ = split_part(file_name)
+    number = split_part(os.path.basename(parts[-1]))[1] + 1 if parts else 1
+    extension = FORMATS[path_format(file_name)]
+    return os.path.join(folder, f"{file_name[:-len(extension) - 1]}.{number}.{extension}")
+
+
+def read_lines(path):
+    """ Lines of a record file without the header.
+        A file not closed is read up to the last line complete.
+    """
+    name = path_format(path)
+    with open_record(path, 'r') as stream:
+        try:
+            if name == 'tsv':
+                next(stream, None)
+            for line in stream:
+                if not line.endswith("\n"):
+                    logger.warning(f"Last line not complete in {path}")
+                    break
+                yield line
+        except TRUNCATED:
+            logger.info(f"Record {path} not closed, read up to the last flush")
+
+
+def record_lines(path):
+    """ Lines of a record and of all its parts """
+    for part in record_parts(path):
+        yield from read_lines(part)
+
+
+def read_record(path):
+    """ Read all messages of a record with its parts, the date as UTC datetime.
+        A record still open is read up to the last flush.
+    """
+    name = path_format(path)
+    for line in record_lines(path):
+        if name == 'tsv':
+            # The text is the last column and can include a separator
+            values = line.rstrip("\n").split(TSV_SEPARATOR, len(MSG_TEXT_ORDER) - 1)
+            if len(values) != len(MSG_TEXT_ORDER):
+                continue
+            msg = dict(zip(MSG_TEXT_ORDER, values))
+            msg['date'] = datetime.fromisoformat(msg['date'])
+            yield msg
+            continue
+        if not line.strip():
+            continue
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            logger.warning(f"Line not valid in {path}")
+            continue
+        msg['date'] = datetime.fromtimestamp(msg['date'], timezone.utc)
+        yield msg
+# EOF
@@ -0,0 +1,129 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import json
+import logging
+from threading import Lock
+
+from .utils import save_config
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Journal of the changes after the last checkpoint
+JOURNAL_FILE = "journal.jsonl"
+# Seconds between two checkpoints
+JOURNAL_CHECKPOINT = 60
+# Maximum entries before a checkpoint, the replay is never longer
+JOURNAL_SIZE = 2000
+
+
+def msg_key(msg):
+    """ Same key for the same message, every edit with a new text is another message """
+    return (msg.get('msg_id'), msg.get('edit', False), msg.get('text'))
+
+
+class Journal:
+    """ Append only journal of the recording states.
+        The state is the last checkpoint with all entries of the journal,
+        a checkpoint stores the state and clear the journal.
+    """
+
+    def __init__(self, checkpoint_file, journal_file, size=JOURNAL_SIZE):
+        self.checkpoint_file = checkpoint_file
+        self.journal_file = journal_file
+        self.size = size
+        self.lock = Lock()
+        self.entries = 0
+        self.stream = None
+
+    def restore(self):
+        """ Load the checkpoint and replay the journal """
+        data = {}
+        if os.path.isfile(self.checkpoint_file):
+            try:
+                with open(self.checkpoint_file) as stream:
+                    data = json.load(stream)
+            except (ValueError, OSError) as e:
+                # The journal is replayed from an empty state
+                logger.error(f"Checkpoint {self.checkpoint_file} not valid: {e}")
+                data = {}
+        # Messages already in the state for each chat
+        seen = {chat_id: set([msg_key(msg) for msg in chat.get('msgs', [])]) for chat_id, chat in data.items()}
+        replayed = 0
+        if os.path.isfile(self.journal_file):
+            with open(self.journal_file) as stream:
+                for line in stream:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line not complete after a crash
+                        logger.warning("Journal line not valid")
+                        continue
+                    self.apply(data, entry, seen)
+                    replayed += 1
+        if replayed:
+            logger.info(f"Replayed {replayed} journal entries")
+        return data
+
+    def apply(self, data, entry, seen):
+        chat = data.setdefault(str(entry['chat']), {'msgs': []})
+        if 'state' in entry:
+            chat.update(entry['state'])
+        if 'msg' in entry:
+            # A message already in the checkpoint is not added again
+            key = msg_key(entry['msg'])
+            keys = seen.setdefault(str(entry['chat']), set())
+            if key not in keys:
+                keys.add(key)
+                chat.setdefault('msgs', []).append(entry['msg'])
+
+    def append(self, entry):
+        """ Add an entry, return True when is time of a checkpoint """
+        with self.lock:
+            if self.stream is None:
+                self.stream = open(self.journal_file, 'a')
+            self.stream.write(json.dumps(entry) + "\n")
+            self.stream.flush()
+            self.entries += 1
+            return self.entries >= self.size
+
+    def checkpoint(self, snapshot):
+        """ Store the state from snapshot() and clear the journal """
+        with self.lock:
+            data = snapshot()
+            save_config(self.checkpoint_file, data)
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            if os.path.isfile(self.journal_file):
+                os.remove(self.journal_file)
+            self.entries = 0
+# EOF
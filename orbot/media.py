@@ -0,0 +1,191 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import json
+import shutil
+import logging
+from hashlib import sha256
+from threading import Lock
+
+from .utils import save_config
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Store folder inside the records folder
+MEDIA_FOLDER = ".media"
+# file_unique_id: object in store
+MEDIA_INDEX = "index.json"
+# New objects after the last index saved
+MEDIA_LOG = "index.jsonl"
+
+
+def file_hash(path):
+    digest = sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class MediaStore:
+    """ All media stored once by content hash and linked in the records folders.
+        A file already in store is never downloaded again.
+    """
+
+    def __init__(self, records_folder):
+        self.folder = os.path.join(records_folder, MEDIA_FOLDER)
+        self.index_file = os.path.join(self.folder, MEDIA_INDEX)
+        self.log_file = os.path.join(self.folder, MEDIA_LOG)
+        self.lock = Lock()
+        self.index = {}
+        self.log = None
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        self.load()
+        self.hardlinks = self.probe()
+        # Statistics
+        self.n_links = 0
+        self.n_same = 0
+
+    def load(self):
+        """ Read the index and the new objects, then save all in the index """
+        if os.path.isfile(self.index_file):
+            try:
+                with open(self.index_file) as stream:
+                    self.index = json.load(stream)
+            except ValueError as e:
+                # Written from an old version without the atomic save, the objects are linked again
+                logger.error(f"Media index {self.index_file} not valid: {e}")
+        if os.path.isfile(self.log_file):
+            with open(self.log_file) as stream:
+                for line in stream:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line not complete
+                        continue
+                    self.index[entry['id']] = entry['object']
+        self.compact()
+
+    def compact(self):
+        """ Save the index and clear the new objects """
+        save_config(self.index_file, self.index)
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        if os.path.isfile(self.log_file):
+            os.remove(self.log_file)
+
+    def probe(self):
+        """ Check if the file system supports hardlinks """
+        probe = os.path.join(self.folder, ".probe")
+        try:
+            with open(probe, 'w'):
+                pass
+            os.link(probe, f"{probe}.link")
+            os.remove(f"{probe}.link")
+            return True
+        except OSError:
+            logger.warning(f"No hardlinks in {self.folder}, media are copied in records")
+            return False
+        finally:
+            if os.path.isfile(probe):
+                os.remove(probe)
+
+    def object_path(self, digest, extension):
+        return os.path.join(self.folder, digest[:2], digest[2:] + extension)
+
+    def place(self, source, path):
+        """ Hardlink the object in the record, a copy if the links are not supported """
+        try:
+            os.link(source, path)
+        except OSError:
+            shutil.copy2(source, path)
+
+    def link(self, unique_id, path):
+        """ Link a file already in store, return False if is not available """
+        with self.lock:
+            source = self.index.get(unique_id)
+            if source is None:
+                return False
+            source = os.path.join(self.folder, source)
+            if not os.path.isfile(source):
+                del self.index[unique_id]
+                return False
+            if not os.path.isfile(path):
+                self.place(source, path)
+            self.n_links += 1
+        return True
+
+    def put(self, unique_id, tmp_path, path):
+        """ Move a file downloaded in store and link it in the record """
+        digest = file_hash(tmp_path)
+        with self.lock:
+            source = self.object_path(digest, os.path.splitext(path)[1])
+            if os.path.isfile(source):
+                # Same content with another file_unique_id
+                os.remove(tmp_path)
+                self.n_same += 1
+            else:
+                os.makedirs(os.path.dirname(source), exist_ok=True)
+                os.replace(tmp_path, source)
+            self.index[unique_id] = os.path.relpath(source, self.folder)
+            # Only a line for each new object
+            if self.log is None:
+                self.log = open(self.log_file, 'a')
+            self.log.write(json.dumps({'id': unique_id, 'object': self.index[unique_id]}) + "\n")
+            self.log.flush()
+            if not os.path.isfile(path):
+                self.place(source, path)
+
+    def clean(self):
+        """ Remove the objects not linked in any record """
+        # Without hardlinks the objects are never in a record
+        if not self.hardlinks:
+            return
+        removed = 0
+        with self.lock:
+            for unique_id, source in list(self.index.items()):
+                source_path = os.path.join(self.folder, source)
+                if not os.path.isfile(source_path):
+                    del self.index[unique_id]
+                elif os.stat(source_path).st_nlink == 1:
+                    os.remove(source_path)
+                    del self.index[unique_id]
+                    removed += 1
+            self.compact()
+        if removed:
+            logger.info(f"Removed {removed} media not used")
+
+    def stats(self):
+        with self.lock:
+            return {'media': len(self.index), 'links': self.n_links, 'same': self.n_same}
+# EOF
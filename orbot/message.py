@@ -0,0 +1,128 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import sys
+from datetime import datetime, timezone
+
+# Fields stored in slots, all others in extra
+MESSAGE_FIELDS = ('msg_id', 'date', 'user_id', 'firstname', 'username', 'text', 'reply_id', 'forward_from', 'edit')
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def timestamp(date):
+    return int(date.timestamp()) if isinstance(date, datetime) else int(date)
+
+
+class Message:
+    """ A message of the chat buffer, with the same access of a dict.
+        The date is an int timestamp, the names are interned.
+    """
+    __slots__ = ('msg_id', 'ts', 'user_id', 'firstname', 'username', 'text', 'reply_id', 'forward_from', 'edit', 'extra')
+
+    def __init__(self, msg_id, date, user_id, firstname, username, text, reply_id='', forward_from='', edit=False):
+        self.msg_id = msg_id
+        self.ts = timestamp(date)
+        self.user_id = user_id
+        self.firstname = intern(firstname)
+        self.username = intern(username)
+        self.text = text
+        self.reply_id = reply_id
+        self.forward_from = forward_from
+        self.edit = edit
+        self.extra = None
+
+    @property
+    def date(self):
+        return datetime.fromtimestamp(self.ts, timezone.utc)
+
+    def __getitem__(self, key):
+        if key == 'date':
+            return self.date
+        if key in MESSAGE_FIELDS:
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'date':
+            self.ts = timestamp(value)
+        elif key in MESSAGE_FIELDS:
+            setattr(self, key, intern(value) if key in ['firstname', 'username'] else value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return key in MESSAGE_FIELDS or (self.extra is not None and key in self.extra)
+
+    def __eq__(self, other):
+        return isinstance(other, Message) and self.to_dict() == other.to_dict()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(MESSAGE_FIELDS) + (list(self.extra) if self.extra is not None else [])
+
+    def to_dict(self):
+        """ Dictionary with the date as timestamp """
+        data = {key: getattr(self, key) for key in MESSAGE_FIELDS if key != 'date'}
+        data['date'] = self.ts
+        if self.extra is not None:
+            data.update(self.extra)
+        return data
+
+    def copy(self):
+        return Message.from_dict(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        msg = cls(data.pop('msg_id'), data.pop('date'), data.pop('user_id'), data.pop('firstname', ''), data.pop('username', None),
+                  data.pop('text', ''), data.pop('reply_id', ''), data.pop('forward_from', ''), data.pop('edit', False))
+        for key, value in data.items():
+            msg[key] = value
+        return msg
+
+    def memory(self):
+        """ Bytes used by the message without the interned names """
+        size = sys.getsizeof(self) + sys.getsizeof(self.text)
+        if self.extra is not None:
+            size += sys.getsizeof(self.extra) + sum([sys.getsizeof(value) for value in self.extra.values()])
+        return size
+# EOF
@@ -33,24 +33,32 @@ import json
 import logging
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, ConversationHandler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Bot, TelegramError
+from telegram.utils.request import Request
 import re
 import os
 from functools import wraps
 from uuid import uuid4
 import sys
 from threading import Thread
+from time import monotonic
 
-from .utils import build_menu, check_key_id, isAdmin, filter_channel, restricted, rtype, register, notify_group
+from .utils import build_menu, check_key_id, isAdmin, filter_channel, restricted, rtype, register, notify_group, HandlerSet
 from .channels import Channels
 from .config import Config
 from .announce import Announce
 from .sites import Sites
 from .record import Record
+from .outbox import Outbox, OutboxBot
+from .transport import Transport
+from .executor import ChatExecutor, CHAT_WORKERS
+from .aio import AsyncLoop
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 # Version match
 VERSION_RE = re.compile(r""".*__version__ = ["'](.*?)['"]""", re.S)
+# Number of dispatcher workers
+WORKERS = 4
 
 
 def get_version():
@@ -67,71 +75,134 @@ class ORbot:
         pass
 
     def __init__(self, settings_file):
+        # Startup time
+        self.started = monotonic()
+        self.startup_time = None
         # Send a message to all admins when the system is started
         version = get_version()
         # Load settings
         self.settings_file = settings_file
-        try:
-            with open(settings_file) as stream:
-                self.settings = json.load(stream)
-        except FileNotFoundError:
-            raise ORbot.BotException(f"Setting file in {self.settings_file} not found")
-        if 'telegram' not in self.settings:
-            raise ORbot.BotException(f"telegram config is not defined on {self.settings_file}")
+        self.settings = self.load_settings()
         telegram = self.settings['telegram']
         # List of admins
-        if 'token' not in telegram:
-            raise ORbot.BotException(f"token is not defined in telegram config")
-        if 'admins' not in telegram:
-            raise ORbot.BotException(f"admins are not defined in telegram config")
         self.LIST_OF_ADMINS = telegram['admins']
         # Create the Updater and pass it your bot's token.
         # Make sure to set use_context=True to use the new context based callbacks
         # Post version 12 this will no longer be necessary
-        self.updater = Updater(telegram['token'], use_context=True)
+        # All messages are sent from the outbox queue
+        self.outbox = Outbox(**telegram.get('outbox', {}))
+        self.outbox.start()
+        chat_workers = int(telegram.get('workers', CHAT_WORKERS))
+        bot = OutboxBot(telegram['token'], outbox=self.outbox, request=Request(con_pool_size=WORKERS + chat_workers + sum(self.outbox.size.values()) + 4))
+        self.updater = Updater(bot=bot, workers=WORKERS, use_context=True)
         # Send startup message
         infobot = self.updater.bot.get_me()
         logger.info(f"Bot: {infobot}")
         notify_group(self.updater.bot, self.LIST_OF_ADMINS, f"🤖 *{infobot.first_name}* (v{version}) started!")
+        # Event loop only for the announce fan-out, the handlers run always on ChatExecutor
+        if 'asyncio' in telegram:
+            logger.warning("telegram.asyncio is renamed in telegram.announce_async, only the announce fan-out uses the event loop")
+        self.aio = AsyncLoop() if telegram.get('announce_async', telegram.get('asyncio', False)) else None
         # Settings manager
         self.channels = Channels(self.updater, self.settings, self.settings_file)
         # Configuration manager
         self.config = Config(self.updater, self.settings, self.settings_file, self.channels)
         # Announce manager
-        self.announce = Announce(self.updater, self.settings, self.settings_file, self.channels)
+        self.announce = Announce(self.updater, self.settings, self.settings_file, self.channels, aio=self.aio)
         # Sites manager
         self.sites = Sites(self.updater, self.settings, self.settings_file, self.channels)
         # Record manager
         self.record = Record(self.updater, self.settings, self.settings_file, self.channels)
+        # Polling or webhook
+        self.transport = Transport(self.updater, self.settings, recording=self.record.isRecording)
         # Get the dispatcher to register handlers
         dp = self.updater.dispatcher
+        self.add_handlers(dp)
+        # log all errors
+        dp.add_error_handler(self.error)
+        # Updates of different chats in parallel
+        self.executor = ChatExecutor(dp, workers=chat_workers)
+
+
+    def load_settings(self):
+        try:
+            with open(self.settings_file) as stream:
+                settings = json.load(stream)
+        except FileNotFoundError:
+            raise ORbot.BotException(f"Setting file in {self.settings_file} not found")
+        except ValueError as e:
+            raise ORbot.BotException(f"Setting file in {self.settings_file} not valid: {e}")
+        if 'telegram' not in settings:
+            raise ORbot.BotException(f"telegram config is not defined on {self.settings_file}")
+        telegram = settings['telegram']
+        if 'token' not in telegram:
+            raise ORbot.BotException(f"token is not defined in telegram config")
+        if 'admins' not in telegram:
+            raise ORbot.BotException(f"admins are not defined in telegram config")
+        return settings
+
+    def add_handlers(self, dp):
         # Add commands
         dp.add_handler(CommandHandler("start", self.start))
         dp.add_handler(CommandHandler("help", self.help))
         dp.add_handler(CommandHandler('restart', self.restart))
+        dp.add_handler(CommandHandler('stats', self.stats))
         # Unknown handler
         unknown_handler = MessageHandler(Filters.command, self.unknown)
         dp.add_handler(unknown_handler)
         # Add group handle
         add_group_handle = MessageHandler(Filters.status_update.new_chat_members, self.add_group)
         dp.add_handler(add_group_handle)
-        # log all errors
-        dp.add_error_handler(self.error)
 
+    def reload(self):
+        """ Load again the settings and register again all handlers
+            without stop the updates, the recordings and the timers """
+        start = monotonic()
+        settings = self.load_settings()
+        # All modules share the same settings, the updates in progress never see it empty
+        self.settings.update(settings)
+        for key in [key for key in self.settings if key not in settings]:
+            del self.settings[key]
+        self.LIST_OF_ADMINS = self.settings['telegram']['admins']
+        for module in [self.channels, self.config, self.sites, self.record]:
+            module.reload()
+        # New outbox limits
+        outbox = self.settings['telegram'].get('outbox', {})
+        self.outbox.limit = tuple(outbox.get('limit', self.outbox.limit))
+        self.outbox.private = tuple(outbox.get('private', self.outbox.private))
+        self.outbox.group = tuple(outbox.get('group', self.outbox.group))
+        # Register all handlers in the same order of the startup
+        handlers = HandlerSet()
+        for module in [self.channels, self.config, self.announce, self.sites, self.record, self.transport, self]:
+            module.add_handlers(handlers)
+        handlers.apply(self.updater.dispatcher)
+        # Check all channels again without block the bot
+        Thread(target=self.channels.check_channels, args=(self.updater.bot,), daemon=True).start()
+        return monotonic() - start
 
     def runner(self):
         bot = self.updater.bot
         # Start the Bot
-        self.updater.start_polling()
+        self.transport.start()
+        self.startup_time = monotonic() - self.started
+        logger.info(f"Bot started in {self.startup_time:.2f}s")
+        # Check all channels without block the bot
+        Thread(target=self.channels.check_channels, args=(bot,), daemon=True).start()
         # Run the bot until you press Ctrl-C or the process receives SIGINT,
         # SIGTERM or SIGABRT. This should be used most of the time, since
-        # start_polling() is non-blocking and will stop the bot gracefully.
+        # start_polling() and start_webhook() are non-blocking and will stop the bot gracefully.
         self.updater.idle()
+        # Wait all updates in progress
+        self.executor.stop()
         # Switch all recording if are actives
         self.record.close_all_records(bot)
         # Send a switch off message
         infobot = bot.get_me()
         notify_group(bot, self.LIST_OF_ADMINS, f"💤 Switch off *{infobot.first_name}*")
+        # Send all messages left
+        self.outbox.stop()
+        if self.aio is not None:
+            self.aio.stop()
 
     @register
     @filter_channel
@@ -152,12 +223,43 @@ class ORbot:
     @restricted
     def restart(self, update, context):
         bot = self.updater.bot
-        # Switch all recording if are actives
-        self.record.close_all_records(bot)
-        # Notify all users
         infobot = context.bot.get_me()
-        notify_group(context.bot, self.LIST_OF_ADMINS, f'⚙️ *{infobot.first_name}* is restarting...')
-        Thread(target=self.stop_and_restart).start()
+        # Restart the process only with /restart hard
+        if context.args and context.args[0] == 'hard':
+            # Switch all recording if are actives
+            self.record.close_all_records(bot)
+            # Notify all users
+            notify_group(context.bot, self.LIST_OF_ADMINS, f'⚙️ *{infobot.first_name}* is restarting...')
+            Thread(target=self.stop_and_restart).start()
+            return
+        try:
+            reload_time = self.reload()
+        except ORbot.BotException as e:
+            logger.error(f"Reload failed: {e}")
+            context.bot.send_message(chat_id=update.effective_chat.id, text=f"⚠️ Reload failed: {e}")
+            return
+        logger.info(f"Reload in {reload_time:.2f}s")
+        notify_group(context.bot, self.LIST_OF_ADMINS, f'⚙️ *{infobot.first_name}* reloaded in {reload_time:.2f}s')
+
+    @filter_channel
+    @rtype(['private'])
+    @restricted
+    def stats(self, update, context):
+        """ Status of the bot """
+        message = "📊 <b>Stats</b>\n"
+        if self.startup_time is not None:
+            message += f" - started in {self.startup_time:.2f}s\n"
+        message += self.channels.stats()
+        values = ", ".join([f"{k}={v}" for k, v in self.outbox.stats().items()])
+        message += f"<b>Outbox:</b>\n - {values}\n"
+        message += self.record.stats()
+        message += self.transport.stats()
+        values = ", ".join([f"{k}={v}" for k, v in self.executor.stats().items()])
+        message += f" - executor: {values}\n"
+        if self.aio is not None:
+            values = ", ".join([f"{k}={v}" for k, v in self.aio.stats().items()])
+            message += f" - announce loop: {values}\n"
+        context.bot.send_message(chat_id=update.effective_chat.id, text=message, parse_mode='HTML')
 
     @register
     @filter_channel
@@ -194,11 +296,13 @@ class ORbot:
                 message += " - /settings channels \n"
                 message += " - Configuration /sites \n"
                 message += " - /config bot \n"
-                message += " - /restart this bot \n"
+                message += " - /restart reload the settings (/restart hard the process) \n"
+                message += " - /stats of this bot \n"
             message += "All commands available in this bot are show below \n"
         # Print all commands availables
         message += " - /start your bot \n"
         message += " - /records download your chat record [BETA] \n"
+        message += " - /search words in your chat records \n"
         message += " - /announce a message in a channel [only channel admin] \n"
         message += " - /info about OR \n"
         message += " - All /channels available \n"
@@ -0,0 +1,307 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+from time import monotonic
+from itertools import count
+from collections import deque
+from threading import Thread, Condition, Event, Lock, current_thread
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Bot
+from telegram.error import RetryAfter
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Priorities, the lower is sent first
+INTERACTIVE, NOTIFY, BULK = range(3)
+# Telegram limits as (messages, seconds)
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_LIMIT = (30, 1)
+PRIVATE_LIMIT = (1, 1)
+GROUP_LIMIT = (20, 60)
+# Workers for the messages and for the uploads
+OUTBOX_WORKERS = 4
+OUTBOX_UPLOADS = 2
+UPLOADS = ['send_document', 'send_photo']
+
+
+def chat_key(chat_id):
+    """ The same key for a chat id as int or as str """
+    try:
+        return int(chat_id)
+    except (TypeError, ValueError):
+        return chat_id
+
+
+def window_delay(sent, limit, now):
+    """ Seconds to wait before a new message in a window of sent messages """
+    messages, period = limit
+    while sent and now - sent[0] >= period:
+        sent.popleft()
+    if len(sent) >= messages:
+        return period - (now - sent[0])
+    return 0
+
+
+class Job:
+
+    def __init__(self, func, args, kwargs, chat_id, priority):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.chat_id = chat_key(chat_id)
+        self.priority = priority
+        # Uploads run on their own workers
+        self.upload = getattr(func, '__name__', '') in UPLOADS
+        self.queued = monotonic()
+        self.done = Event()
+        self.result = None
+        self.error = None
+        self.callbacks = []
+        self.lock = Lock()
+
+    def add_done_callback(self, callback):
+        """ Run callback(job) when the job is sent """
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks += [callback]
+                return
+        callback(self)
+
+    def finish(self):
+        with self.lock:
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Outbox:
+    """ Outbound queue for all messages sent by the bot.
+        Messages are handed out by priority with a global and a per chat rate limit
+        to a pool of workers, uploads have their own workers and never hold the messages.
+        Only one message for each chat is in progress, to keep the order in the chat.
+        A RetryAfter from telegram pause the queue and the message is sent again.
+    """
+
+    def __init__(self, limit=GLOBAL_LIMIT, private=PRIVATE_LIMIT, group=GROUP_LIMIT, workers=OUTBOX_WORKERS, uploads=OUTBOX_UPLOADS):
+        self.limit = tuple(limit)
+        self.private = tuple(private)
+        self.group = tuple(group)
+        # Workers for messages (False) and uploads (True)
+        self.size = {False: int(workers), True: int(uploads)}
+        self.busy = {False: 0, True: 0}
+        self.pools = {}
+        self.running = set()
+        self.queue = []
+        self.counter = count()
+        self.cond = Condition()
+        # Last sends
+        self.sent = deque()
+        self.chats = {}
+        self.pause = 0
+        self.thread = None
+        # Statistics
+        self.n_sent = 0
+        self.n_retry = 0
+        self.latency = 0
+        self.max_latency = 0
+
+    def start(self):
+        self.pools = {upload: ThreadPoolExecutor(max_workers=size, thread_name_prefix='outbox')
+                      for upload, size in self.size.items()}
+        self.thread = Thread(target=self.run, name="outbox", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        thread = self.thread
+        with self.cond:
+            self.thread = None
+            self.cond.notify_all()
+        if thread is not None:
+            thread.join()
+
+    def put(self, func, args, kwargs, chat_id, priority=INTERACTIVE):
+        """ Queue a message without wait, return the job """
+        job = Job(func, args, kwargs, chat_id, priority)
+        # Send directly if the queue is not running or from the queue itself
+        if self.thread is None or current_thread().name.startswith('outbox'):
+            try:
+                job.result = func(*args, **kwargs)
+            except Exception as e:
+                job.error = e
+            job.finish()
+            return job
+        with self.cond:
+            self.queue += [(priority, next(self.counter), job)]
+            self.cond.notify_all()
+        return job
+
+    def call(self, func, args, kwargs, chat_id, priority=INTERACTIVE):
+        return self.put(func, args, kwargs, chat_id, priority).wait()
+
+    def delay(self, chat_id, now):
+        """ Seconds to wait before send a message in chat_id """
+        delay = max(self.pause - now, window_delay(self.sent, self.limit, now))
+        # Chat rate
+        if chat_id in self.chats:
+            limit = self.private if str(chat_id).isdigit() else self.group
+            delay = max(delay, window_delay(self.chats[chat_id], limit, now))
+            if not self.chats[chat_id]:
+                del self.chats[chat_id]
+        return delay
+
+    def next_job(self):
+        while self.thread is not None:
+            now = monotonic()
+            wait = None
+            for item in sorted(self.queue, key=lambda item: item[:2]):
+                job = item[2]
+                # Wait a free worker and the end of the last message in the chat
+                if self.busy[job.upload] >= self.size[job.upload] or job.chat_id in self.running:
+                    continue
+                delay = self.delay(job.chat_id, now)
+                if delay <= 0:
+                    self.queue.remove(item)
+                    return item
+                wait = delay if wait is None else min(wait, delay)
+            self.cond.wait(timeout=wait)
+        return None
+
+    def run(self):
+        while True:
+            with self.cond:
+                item = self.next_job()
+                if item is None:
+                    break
+                _, _, job = item
+                now = monotonic()
+                self.sent.append(now)
+                if job.chat_id is not None:
+                    self.chats.setdefault(job.chat_id, deque()).append(now)
+                    self.running.add(job.chat_id)
+                self.busy[job.upload] += 1
+            self.pools[job.upload].submit(self.send, item)
+        # Wait the messages in progress
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
+        # Send all messages left
+        for _, _, job in self.queue:
+            try:
+                job.result = job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                job.error = e
+            job.finish()
+        self.queue = []
+
+    def send(self, item):
+        _, _, job = item
+        try:
+            job.result = job.func(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            logger.warning(f"Outbox paused for {e.retry_after}s")
+            with self.cond:
+                self.n_retry += 1
+                self.pause = monotonic() + e.retry_after
+                # Send again with the same order
+                self.queue += [item]
+                self.release(job)
+            return
+        except Exception as e:
+            job.error = e
+        with self.cond:
+            # Update statistics
+            latency = monotonic() - job.queued
+            self.n_sent += 1
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.release(job)
+        job.finish()
+
+    def release(self, job):
+        self.busy[job.upload] -= 1
+        self.running.discard(job.chat_id)
+        self.cond.notify_all()
+
+    def stats(self):
+        latency = self.latency / self.n_sent if self.n_sent else 0
+        return {'depth': len(self.queue), 'running': sum(self.busy.values()), 'sent': self.n_sent, 'retry': self.n_retry,
+                'latency': f"{latency:.2f}s", 'max_latency': f"{self.max_latency:.2f}s"}
+
+
+class OutboxBot(Bot):
+    """ Bot with all sends and edits in the outbox.
+        All methods accept the optional priority argument.
+    """
+
+    def __init__(self, *args, outbox=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = outbox
+
+    def queued(self, func, args, kwargs):
+        priority = kwargs.pop('priority', INTERACTIVE)
+        chat_id = kwargs.get('chat_id', args[0] if args else None)
+        if self.outbox is None:
+            return func(*args, **kwargs)
+        return self.outbox.call(func, args, kwargs, chat_id, priority)
+
+    def submit(self, name, *args, **kwargs):
+        """ Queue a send or an edit without wait, return the outbox job """
+        func = getattr(super(), name)
+        priority = kwargs.pop('priority', INTERACTIVE)
+        chat_id = kwargs.get('chat_id', args[0] if args else None)
+        if self.outbox is None:
+            return Outbox().put(func, args, kwargs, chat_id, priority)
+        return self.outbox.put(func, args, kwargs, chat_id, priority)
+
+    def send_message(self, *args, **kwargs):
+        return self.queued(super().send_message, args, kwargs)
+
+    def forward_message(self, *args, **kwargs):
+        return self.queued(super().forward_message, args, kwargs)
+
+    def send_photo(self, *args, **kwargs):
+        return self.queued(super().send_photo, args, kwargs)
+
+    def send_document(self, *args, **kwargs):
+        return self.queued(super().send_document, args, kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        return self.queued(super().edit_message_text, args, kwargs)
+
+    def edit_message_caption(self, *args, **kwargs):
+        return self.queued(super().edit_message_caption, args, kwargs)
+# EOF
@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Buckets of the sliding window
+RATE_BUCKETS = 60
+
+
+class RateMeter:
+    """ Messages of a chat in a sliding window, counted in fixed buckets.
+        Every new message is a constant time update, the memory doesn't depend on the window.
+    """
+
+    def __init__(self, window, buckets=RATE_BUCKETS):
+        # Window in seconds
+        self.window = window
+        self.buckets = buckets
+        self.step = window / buckets
+        self.counts = [0] * buckets
+        # Last bucket in use and messages in the window
+        self.last = 0
+        self.total = 0
+
+    def advance(self, ts):
+        bucket = int(ts // self.step)
+        gap = bucket - self.last
+        if gap <= 0:
+            return
+        if gap >= self.buckets:
+            # All buckets out of the window
+            self.counts = [0] * self.buckets
+            self.total = 0
+        else:
+            # Clean only the buckets passed
+            for idx in range(self.last + 1, bucket + 1):
+                self.total -= self.counts[idx % self.buckets]
+                self.counts[idx % self.buckets] = 0
+        self.last = bucket
+
+    def add(self, ts):
+        """ Count a message at the timestamp ts """
+        self.advance(ts)
+        bucket = int(ts // self.step)
+        # Skip messages older than the window
+        if bucket <= self.last - self.buckets:
+            return
+        self.counts[bucket % self.buckets] += 1
+        self.total += 1
+
+    def count(self, ts):
+        """ Messages in the window ending at ts, without changes """
+        bucket = int(ts // self.step)
+        gap = bucket - self.last
+        if gap <= 0:
+            return self.total
+        if gap >= self.buckets:
+            return 0
+        return self.total - sum([self.counts[idx % self.buckets] for idx in range(self.last + 1, bucket + 1)])
+
+    def rate(self, ts):
+        """ Messages for minute in the window ending at ts """
+        return self.count(ts) * 60 / self.window
+# EOF
@@ -28,9 +28,12 @@
 # OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
 # EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from threading import Thread
-import json
+from threading import Thread, Lock, RLock
+from functools import wraps
+from time import monotonic, time
+from math import ceil
 import re
+import html
 from uuid import uuid1, uuid4
 from collections import deque
 import os
@@ -44,12 +47,22 @@ from telegram.ext import (Updater,
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Bot, TelegramError, ChatAction
 from telegram.error import BadRequest
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 import shutil
-from urllib.parse import urlparse
 from os.path import splitext, basename
 # Menu 
-from .utils import build_menu, check_key_id, isAdmin, filter_channel, restricted, rtype, zip_record, save_config, register
+from .outbox import NOTIFY
+from .writer import RecordWriter
+from .archive import Archives
+from .downloads import DownloadPool, DOWNLOADS_FILE
+from .media import MediaStore
+from .catalog import Catalog, CATALOG_COMMIT, highlight
+from .cache import NOT_MEMBER, UNKNOWN
+from .message import Message
+from .rate import RateMeter
+from .journal import Journal, JOURNAL_FILE, JOURNAL_CHECKPOINT
+from .formats import FORMATS, RECORD_FORMAT, record_format, path_format, header, encode, next_part, record_parts
+from .utils import build_menu, check_key_id, isAdmin, filter_channel, restricted, rtype, register
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -57,25 +70,56 @@ logger = logging.getLogger(__name__)
 BETA = False
 START = 'start'
 STOP = 'stop'
+# Interval of the autoreply ticker
+TICK = 2
+# Countdown steps as (step, more than seconds left), the last seconds are not shown
+COUNTDOWN = [(30, 30), (10, 10)]
 
-class Downloader(Thread):
 
-    def __init__(self, newFile, path, file_name):
-        super().__init__()
-        self.newFile = newFile
-        self.path = path
-        self.file_name = file_name
-        # https://www.bogotobogo.com/python/Multithread/python_multithreading_Daemon_join_method_threads.php
-        self.daemon = True
+class Ticker:
+    """ A single job drives the countdown of all autoreply messages """
+
+    def __init__(self, updater, interval=TICK):
+        self.autoreplies = {}
+        self.lock = Lock()
+        # Bot user, loaded only once
+        self.user = None
+        # Statistics
+        self.edits = 0
+        self.saved = 0
+        self.job_queue = updater.job_queue
+        self.job = updater.job_queue.run_repeating(self.tick, interval=interval, first=interval)
+        self.job.enabled = False
+
+    def add(self, autoreply):
+        with self.lock:
+            self.autoreplies[id(autoreply)] = autoreply
+            self.job.enabled = True
+
+    def remove(self, autoreply):
+        with self.lock:
+            if self.autoreplies.pop(id(autoreply), None) is None:
+                return False
+            # Edits not required compared with an edit for each interval
+            self.saved += max(0, int(autoreply.elapsed() // autoreply.interval) - autoreply.edits)
+            self.job.enabled = bool(self.autoreplies)
+        return True
+
+    def get_me(self, bot):
+        if self.user is None:
+            self.user = bot.get_me()
+        return self.user
+
+    def tick(self, context: CallbackContext):
+        with self.lock:
+            autoreplies = list(self.autoreplies.values())
+        for autoreply in autoreplies:
+            autoreply.tick(context.bot)
 
-    def run(self):
-        logger.info(f"Downloading... {self.file_name}")
-        self.newFile.download(self.path)
-        logger.info(f"Downloaded {self.file_name}")
 
 class Autoreply:
 
-    def __init__(self, updater, context, chat_id, type, text, func_timeout, data, time=60, interval=10, keyID=None):
+    def __init__(self, ticker, context, chat_id, type, text, func_timeout, data, time=60, interval=10, keyID=None):
         # Usually th e keyID is automatically generated.
         # Do not use a keyID in a job timer message
         if keyID is None:
@@ -83,52 +127,64 @@ class Autoreply:
             keyID = str(uuid4())
             # Set the user data
             context.user_data[keyID] = {'chat_id': chat_id}
+        self.ticker = ticker
         # set total time
         self.time = time
+        self.started = monotonic()
         # Interval update message
         self.interval = interval
         # Make control buttons
         msg = self.ctrl_buttons(context.bot, chat_id, keyID, type, text)
-        # Initialize the context to share
-        data_timer = {'timer': self.time,
-                      'message': msg.message_id,
-                      'chat_id': chat_id,
-                      'keyID': keyID,
-                      'text': text,
-                      'func_timeout': func_timeout,
-                      'data': data,
-                      'type_cb': type}
-        # add job in recording dictionary
-        self.job = updater.job_queue.run_repeating(self.timer_autoreply, context=data_timer, interval=self.interval, first=self.interval)
+        self.message_id = msg.message_id
+        self.chat_id = chat_id
+        self.keyID = keyID
+        self.text = text
+        self.func_timeout = func_timeout
+        self.data = data
+        self.type_cb = type
+        # Last text shown
+        self.shown = text
+        self.edits = 0
+        # add in the shared ticker
+        self.ticker.add(self)
 
     def stop(self):
         # Stop the autoreply timer
-        self.job.enabled = False  # Temporarily disable this job
-        self.job.schedule_removal()  # Remove this job completely
-
-    def timer_autoreply(self, context: CallbackContext):
-        # Get job data
-        job = context.job
-        data_timer = context.job.context
-        # Extract all context parameter
-        timer = data_timer['timer']
-        message_id = data_timer['message']
-        chat_id = data_timer['chat_id']
-        keyID = data_timer['keyID']
-        text = data_timer['text']
-        type_cb = data_timer['type_cb']
-        user = context.bot.get_me()
-        # Update control buttons and text
-        self.ctrl_buttons(context.bot, chat_id, keyID, type_cb, f"{text} _({timer}s left)_", message_id)
-        # Decrease timer
-        context.job.context['timer'] -= self.interval
+        self.ticker.remove(self)
+
+    def elapsed(self):
+        return monotonic() - self.started
+
+    def countdown(self, left):
+        """ Time left shown in the message, None to keep the last message """
+        for step, threshold in COUNTDOWN:
+            if left > threshold:
+                return int(ceil(left / step) * step)
+        return None
+
+    def tick(self, bot):
+        left = self.time - self.elapsed()
         # If timer left remove timer and send a message
-        if timer <= 0:
-            job.schedule_removal()
-            # Send the message
-            func_timeout = data_timer['func_timeout']
-            data = [type_cb, keyID, data_timer['data']]
-            func_timeout(context.bot, message_id, chat_id, data, user)
+        if left <= 0:
+            # Run only if not stopped
+            if self.ticker.remove(self):
+                data = [self.type_cb, self.keyID, self.data]
+                user = self.ticker.get_me(bot)
+                # Run in a new job, a callback can send a record and never stop the countdown of the other chats
+                self.ticker.job_queue.run_once(lambda context: self.func_timeout(context.bot, self.message_id, self.chat_id, data, user), 0)
+            return
+        countdown = self.countdown(left)
+        if countdown is None:
+            return
+        text = f"{self.text} _({countdown}s left)_"
+        # Skip unchanged messages
+        if text == self.shown:
+            return
+        # Update control buttons and text
+        self.ctrl_buttons(bot, self.chat_id, self.keyID, self.type_cb, text, self.message_id)
+        self.shown = text
+        self.edits += 1
+        self.ticker.edits += 1
 
     def ctrl_buttons(self, bot, chat_id, keyID, type_cb, message, edit_msg=None):
         yes = InlineKeyboardButton("✅", callback_data=f"{type_cb} {keyID} true")
@@ -147,10 +203,54 @@ class Autoreply:
                                            parse_mode='Markdown',
                                            reply_markup=reply_markup)
 
+
+def update_chat(update, context):
+    return update.effective_chat.id
+
+
+def callback_chat(bot, message_id, chat_id, data, user):
+    return chat_id
+
+
+def job_chat(context):
+    return context.job.context
+
+
+def locked(key):
+    """ Run with the recording lock of the chat returned from key """
+    def chat_locked(func):
+        @wraps(func)
+        def wrapped(self, *args):
+            chat_id = key(*args)
+            with self.chat_lock(chat_id):
+                try:
+                    return func(self, *args)
+                finally:
+                    # Store all changes of the chat
+                    self.journal_chat(chat_id)
+        return wrapped
+    return chat_locked
+
+
 RECORDS_FILE = "records.json"
+# Number of chats listed with the buffers memory
+RECORD_STATS_TOP = 5
+# State saved in the journal
+JOURNAL_STATE = ['status', 'folder_record', 'file_name', 'edit_msg']
+
+
+def journal_msg(msg):
+    if isinstance(msg, Message):
+        return msg.to_dict()
+    data = dict(msg)
+    if isinstance(data['date'], datetime):
+        data['date'] = int(data['date'].timestamp())
+    return data
+
+
 IDLE, WAIT_START, WAIT_STOP, WRITING = range(4)
 RECORDING = 'RECORDING'
-MSG_TEXT_ORDER = ['date', 'user_id', 'firstname', 'msg_id', 'edit', 'reply_id', 'forward_from', 'text']
+
 
 def make_dict_message(update, text, edit=False):
     # Message ID
@@ -168,16 +268,7 @@ def make_dict_message(update, text, edit=False):
     # Reply id
     forward_from = update.message.forward_from.id if update.message.forward_from else ''
     # Make message
-    msg = {'msg_id': msg_id,
-            'date': date,
-            'user_id': user_id,
-            'firstname': firstname,
-            'username': username,
-            'text': text,
-            'reply_id': reply_id,
-            'forward_from': forward_from,
-            'edit': edit}
-    return msg
+    return Message(msg_id, date, user_id, firstname, username, text, reply_id, forward_from, edit)
 
 
 class Record:
@@ -189,38 +280,144 @@ class Record:
         self.channels = channels
         # Timeout autostop
         self.timeout = 10 * 60
-        self.extension = "csv"
         self.size_record_chat = 10
         self.min_delta = 10
         self.d_start = 10 * 60
-        self.separator = "\t"
         # Recording status
         self.recording = {}
+        # Memberships loaded in background for the menus
+        self.seeding = set()
+        self.seeding_lock = Lock()
+        # Messages rate and autostart limits of each chat
+        self.rates = {}
+        self.limits = {}
+        # Recording locks for each chat
+        self.locks = {}
+        self.locks_lock = Lock()
         # Initialize folder records
         records = self.settings['config'].get('records', {})
         self.records_folder = records.get('folder', 'records')
         if not os.path.isdir(self.records_folder):
             os.mkdir(self.records_folder)
             logger.info(f"Directory {self.records_folder} created")
-        # Restore all conversations
+        # Restore all conversations from the last checkpoint and the journal
+        self.closed = False
+        self.journal = Journal(f"{self.records_folder}/{RECORDS_FILE}", f"{self.records_folder}/{JOURNAL_FILE}")
+        self.journaled = {}
         size_record_chat = int(records.get('msgs', self.size_record_chat))
-        if os.path.isfile(f"{self.records_folder}/{RECORDS_FILE}"):
-            with open(f"{self.records_folder}/{RECORDS_FILE}") as stream:
-                data = json.load(stream)
+        data = self.journal.restore()
+        if data:
             for chat_id in data:
                 logger.info(f"Load {chat_id} records")
-                status = data[chat_id]['status']
-                # Convert all timestamps in datetime
-                for msg in data[chat_id]['msgs']:
-                    msg['date'] = datetime.fromtimestamp(msg['date'])
-                    # Manage 
-                    msg['edit'] = False if 'edit' not in msg else msg['edit']
+                status = data[chat_id].get('status', IDLE)
+                # Convert all messages in compact records
+                msgs = [Message.from_dict(msg) for msg in data[chat_id]['msgs']]
                 # Restore all recording
-                self.recording[int(chat_id)] = {'status': status, 'msgs': deque(data[chat_id]['msgs'], maxlen=size_record_chat)}
+                self.recording[int(chat_id)] = {'status': status, 'msgs': deque(msgs, maxlen=size_record_chat)}
+        # Archives of the records downloaded
+        self.archives = Archives(self.records_folder)
+        # Index of all records
+        self.catalog = Catalog(self.records_folder)
+        self.updater.job_queue.run_repeating(lambda context: self.catalog.commit(), interval=CATALOG_COMMIT, first=CATALOG_COMMIT)
+        Thread(target=self.catalog_titles, daemon=True).start()
+        # Media shared by all records
+        self.media = MediaStore(self.records_folder)
+        Thread(target=self.media.clean, daemon=True).start()
+        # Format of the new records
+        self.format = record_format(records.get('format', RECORD_FORMAT))
         # Job queue
         self.job = self.updater.job_queue
-        # Get the dispatcher to register handlers
-        dp = self.updater.dispatcher
+        # Open files of all recordings
+        self.writer = RecordWriter(self.job, **records.get('writer', {}))
+        # Countdown of all autoreply
+        self.ticker = Ticker(self.updater)
+        # Register handlers
+        self.add_handlers(self.updater.dispatcher)
+        # Restart all records
+        context = CallbackContext(self.updater.dispatcher)
+        for chat_id in self.recording:
+            if self.recording[chat_id]['status'] in [WRITING, WAIT_STOP] and 'folder_record' not in data[str(chat_id)]:
+                self.recording[chat_id]['status'] = IDLE
+            if self.recording[chat_id]['status'] in [WRITING, WAIT_STOP]:
+                self.recording[chat_id]['folder_record'] = data[str(chat_id)]['folder_record']
+                self.recording[chat_id]['file_name'] = data[str(chat_id)]['file_name']
+                # After a crash the file can end with a compressed stream broken, continue in a new part
+                if 'edit_msg' not in data[str(chat_id)]:
+                    path = f"{self.records_folder}/{str(chat_id)[1:]}/{self.recording[chat_id]['folder_record']}"
+                    part = next_part(f"{path}/{self.recording[chat_id]['file_name']}")
+                    self.writer.create(part, header(path_format(part)))
+                    self.recording[chat_id]['file_name'] = os.path.basename(part)
+                    logger.info(f"Chat {chat_id} restored after a crash in {part}")
+                self.catalog.start(str(chat_id)[1:], self.recording[chat_id]['folder_record'], chat_id)
+                # Start timer
+                self.job_timer_start(chat_id)
+                # Message to send, a new message after a crash
+                text = f"*RESTORE* 📼 *Recording*..."
+                try:
+                    if 'edit_msg' in data[str(chat_id)]:
+                        self.updater.bot.edit_message_text(chat_id=chat_id, text=text, message_id=data[str(chat_id)]['edit_msg'], parse_mode='Markdown')
+                    else:
+                        self.updater.bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown', priority=NOTIFY)
+                except BadRequest:
+                    pass
+            # Ask again to stop
+            if self.recording[chat_id]['status'] in [WAIT_STOP]:
+                text = "*TOK TOK* There is anyone here?\n🚫 Do you want *stop* now? 🚫"
+                self.recording[chat_id]['job_autoreply'] = Autoreply(self.ticker, context, chat_id, 'REC_TIMER_STOP', text, self.cb_stop, 'true', keyID=chat_id)
+            if self.recording[chat_id]['status'] in [WAIT_START]:
+                self.recording[chat_id]['status'] = IDLE
+            self.journaled[chat_id] = (self.journal_state(chat_id), self.recording[chat_id]['msgs'][-1] if self.recording[chat_id]['msgs'] else None)
+        # Files of the records, after the new parts of the records restored
+        self.downloads = DownloadPool(self.updater.bot, f"{self.records_folder}/{DOWNLOADS_FILE}", landed=self.landed,
+                                      store=self.media, **records.get('downloads', {}))
+        # New checkpoint with the state restored
+        self.journal.checkpoint(self.snapshot)
+        self.job.run_repeating(self.checkpoint, interval=JOURNAL_CHECKPOINT, first=JOURNAL_CHECKPOINT)
+
+    def journal_state(self, chat_id):
+        return {key: self.recording[chat_id][key] for key in JOURNAL_STATE if key in self.recording[chat_id]}
+
+    def journal_chat(self, chat_id):
+        """ Add in the journal the new state and the new messages of a chat """
+        if self.closed or chat_id not in self.recording:
+            return
+        state, last = self.journaled.get(chat_id, (None, None))
+        new_state = self.journal_state(chat_id)
+        full = False
+        if new_state != state:
+            full = self.journal.append({'chat': chat_id, 'state': new_state}) or full
+        # Messages after the last in journal
+        msgs = []
+        for msg in reversed(self.recording[chat_id]['msgs']):
+            if msg is last:
+                break
+            msgs.insert(0, msg)
+        for msg in msgs:
+            full = self.journal.append({'chat': chat_id, 'msg': journal_msg(msg)}) or full
+        self.journaled[chat_id] = (new_state, msgs[-1] if msgs else last)
+        if full:
+            self.journal.checkpoint(self.snapshot)
+
+    def snapshot(self):
+        data = {}
+        for chat_id, recording in list(self.recording.items()):
+            data[str(chat_id)] = self.journal_state(chat_id)
+            data[str(chat_id)]['msgs'] = [journal_msg(msg) for msg in list(recording['msgs'])]
+        return data
+
+    def checkpoint(self, context):
+        if not self.closed:
+            self.journal.checkpoint(self.snapshot)
+
+    def reload(self):
+        records = self.settings['config'].get('records', {})
+        self.format = record_format(records.get('format', RECORD_FORMAT))
+        # Journal, downloads, media, index and open records live in the folder
+        folder = records.get('folder', 'records')
+        if folder != self.records_folder:
+            logger.warning(f"Records folder {folder} used only after /restart hard, now {self.records_folder}")
+
+    def add_handlers(self, dp):
         # Text recorder
         text_handler = MessageHandler(Filters.text, self.record)
         dp.add_handler(text_handler)
@@ -235,28 +432,132 @@ class Record:
         dp.add_handler(CallbackQueryHandler(self.player_control, pattern='REC_PLAYER'))
         # Query messages
         dp.add_handler(CommandHandler('records', self.records))
+        dp.add_handler(CommandHandler('search', self.search))
         dp.add_handler(CallbackQueryHandler(self.rec_folder, pattern='REC_DATA'))
         dp.add_handler(CallbackQueryHandler(self.rec_download, pattern='REC_DOWNLOAD'))
         dp.add_handler(CallbackQueryHandler(self.rec_cancel, pattern='REC_CN'))
         dp.add_handler(CallbackQueryHandler(self.start, pattern='REC_START'))
         dp.add_handler(CallbackQueryHandler(self.stop, pattern='REC_STOP'))
         dp.add_handler(CallbackQueryHandler(self.timer_stop_cb, pattern='REC_TIMER_STOP'))
-        # Restart all records
-        for chat_id in self.recording:
-            if self.recording[chat_id]['status'] in [WRITING, WAIT_STOP]:
-                self.recording[chat_id]['folder_record'] = data[str(chat_id)]['folder_record']
-                self.recording[chat_id]['file_name'] = data[str(chat_id)]['file_name']
-                message_id = data[str(chat_id)]['edit_msg']
-                # Start timer
-                self.job_timer_start(chat_id)
-                # Message to send
-                try:
-                    text = f"*RESTORE* 📼 *Recording*..."
-                    self.updater.bot.edit_message_text(chat_id=chat_id, text=text, message_id=message_id, parse_mode='Markdown')
-                except BadRequest:
-                    pass
-            if self.recording[chat_id]['status'] in [WAIT_START]:
-                self.recording[chat_id]['status'] = IDLE
+
+    def download(self, chat_id, msg, file_id, file_name):
+        """ Queue the file of a message in the folder of the record """
+        # Attention chat in absolute value !!!!!!!!!!!!!
+        folder_name = str(chat_id)[1:]
+        folder_record = self.recording[chat_id]['folder_record']
+        path = f"{self.records_folder}/{folder_name}/{folder_record}"
+        record = f"{path}/{self.recording[chat_id]['file_name']}"
+        self.downloads.add(file_id, msg.get('file_unique_id', file_id), f"{path}/{file_name}",
+                           size=msg.get('file_size'), record=record, msg_id=msg['msg_id'])
+
+    def catalog_titles(self):
+        """ Title of the chats indexed without a title """
+        for folder, chat_id in self.catalog.untitled():
+            try:
+                self.catalog.title(folder, self.channels.getChat(self.updater.bot, chat_id).title)
+            except TelegramError:
+                logger.warning(f"This {chat_id} does not exist!")
+        self.catalog.commit()
+
+    def landed(self, task, size):
+        """ Add a row in the record when a file is downloaded """
+        if task['record'] is None:
+            return
+        file_name = basename(task['path'])
+        msg = {'msg_id': task['msg_id'],
+               'date': datetime.now(timezone.utc),
+               'user_id': '',
+               'firstname': '',
+               'username': '',
+               'text': f"Landed {file_name}",
+               'reply_id': '',
+               'forward_from': '',
+               'edit': False,
+               'landed': file_name,
+               'size': size}
+        # In the last part, the record can be continued after a crash
+        parts = record_parts(task['record'])
+        record = parts[-1] if parts else task['record']
+        self.writer.write(record, encode(path_format(record), msg))
+        record_path = os.path.dirname(task['path'])
+        self.catalog.media(basename(os.path.dirname(record_path)), basename(record_path), size)
+        # Close the file if the recording is stopped
+        if not any([record.endswith(f"/{rec.get('folder_record')}/{rec.get('file_name')}")
+                    for rec in list(self.recording.values()) if rec['status'] in [WRITING, WAIT_STOP]]):
+            self.writer.close(record)
+
+    def chat_lock(self, chat_id):
+        with self.locks_lock:
+            if chat_id not in self.locks:
+                self.locks[chat_id] = RLock()
+            return self.locks[chat_id]
+
+    def isRecording(self, chat_id):
+        if chat_id not in self.recording:
+            return False
+        return self.recording[chat_id]['status'] in [WRITING, WAIT_STOP]
+
+    def stats(self):
+        text = "<b>Records:</b>\n"
+        text += f" - autoreply edits: {self.ticker.edits}, saved: {self.ticker.saved}\n"
+        values = ", ".join([f"{k}={v}" for k, v in self.writer.stats().items()])
+        text += f" - writer: {values}\n"
+        values = ", ".join([f"{k}={v}" for k, v in self.archives.stats().items()])
+        text += f" - archives: {values}\n"
+        values = ", ".join([f"{k}={v}" for k, v in self.downloads.stats().items()])
+        text += f" - downloads: {values}\n"
+        values = ", ".join([f"{k}={v}" for k, v in self.media.stats().items()])
+        text += f" - media: {values}\n"
+        # Memory used from the messages buffers
+        sizes = {chat_id: sum([msg.memory() for msg in list(rec['msgs'])]) for chat_id, rec in list(self.recording.items())}
+        text += f" - buffers: chats={len(sizes)}, msgs={sum([len(rec['msgs']) for rec in list(self.recording.values())])}, bytes={sum(sizes.values())}\n"
+        for chat_id, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True)[:RECORD_STATS_TOP]:
+            text += f"   {self.get_chat_title(str(chat_id)[1:])}: {size} bytes\n"
+        # Messages rate, with the autostart threshold
+        rates = self.rates_top()
+        text += f" - rates: chats={len(self.rates)}, active={len(rates)}\n"
+        for chat_id, rate in rates:
+            text += f"   {self.get_chat_title(str(chat_id)[1:])}: {rate['rate']:.1f} msgs/min ({rate['count']}/{rate['msgs']} in {rate['minutes']}min)\n"
+        return text
+
+    def autostart_limits(self, chat_id):
+        """ Messages and minutes to auto start a record, from the channel or the records config """
+        records = self.settings['config'].get('records', {})
+        channel = self.settings['channels'].get(str(chat_id), {}).get('autostart', {})
+        key = (records.get('msgs'), records.get('min_start'), channel.get('msgs'), channel.get('min_start'))
+        # Parse again only if the settings are changed
+        if chat_id not in self.limits or self.limits[chat_id][0] != key:
+            msgs = int(channel.get('msgs', max(1, int(records.get('msgs', self.size_record_chat)) // 2)))
+            minutes = int(channel.get('min_start', records.get('min_start', self.min_delta)))
+            self.limits[chat_id] = (key, msgs, minutes)
+        return self.limits[chat_id][1:]
+
+    def buffer(self, chat_id, msg):
+        """ Add a message in the chat buffer and in the rate meter """
+        self.recording[chat_id]['msgs'].append(msg)
+        _, minutes = self.autostart_limits(chat_id)
+        meter = self.rates.get(chat_id)
+        if meter is not None and meter.window == minutes * 60:
+            meter.add(msg.ts)
+            return
+        # New meter, count all messages in the buffer
+        meter = RateMeter(minutes * 60)
+        for old in list(self.recording[chat_id]['msgs']):
+            meter.add(old.ts)
+        self.rates[chat_id] = meter
+
+    def get_rates(self, now=None):
+        """ Messages rate of all chats """
+        now = time() if now is None else now
+        rates = {}
+        for chat_id, meter in list(self.rates.items()):
+            msgs, minutes = self.autostart_limits(chat_id)
+            rates[chat_id] = {'rate': meter.rate(now), 'count': meter.count(now), 'msgs': msgs, 'minutes': minutes}
+        return rates
+
+    def rates_top(self):
+        rates = [(chat_id, rate) for chat_id, rate in self.get_rates().items() if rate['count'] > 0]
+        return sorted(rates, key=lambda item: item[1]['rate'], reverse=True)[:RECORD_STATS_TOP]
 
     def add_text(self, update, context, edit=False):
         chat_id = update.effective_chat.id
@@ -265,7 +566,7 @@ class Record:
         # Make message
         msg = make_dict_message(update, text, edit)
         # Add message in queue text
-        self.recording[chat_id]['msgs'].append(msg)
+        self.buffer(chat_id, msg)
         # Recording funcions
         if self.recording[chat_id]['status'] in [WRITING, WAIT_STOP]:
             # Write message on history
@@ -273,6 +574,8 @@ class Record:
         return text
 
     def close_all_records(self, bot):
+        # No more changes in journal
+        self.closed = True
         data = {}
         infobot = bot.get_me()
         for chat_id in self.recording:
@@ -287,51 +590,68 @@ class Record:
                 self.recording[chat_id]['status'] = IDLE
                 # Send message
                 text = f"💤 Switch off <b>{infobot.first_name}</b>"
-                msg = bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML')
+                msg = bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML', priority=NOTIFY)
                 data[chat_id]['edit_msg'] = msg.message_id
             # Store records
-            for msg in self.recording[chat_id]['msgs']:
-                msg['date'] = int(msg['date'].timestamp())
-            data[chat_id]['msgs'] = list(self.recording[chat_id]['msgs'])
-        # Save configuration
-        save_config(f"{self.records_folder}/{RECORDS_FILE}", data)
+            data[chat_id]['msgs'] = [msg.to_dict() for msg in self.recording[chat_id]['msgs']]
+        # Finish the downloads in progress and close all files
+        self.downloads.stop()
+        self.writer.close()
+        self.catalog.close()
+        # Save configuration and clear the journal
+        self.journal.checkpoint(lambda: data)
+
+    def get_chats(self, context, user_id):
+        """ All chats with records for a user: [(folder, title)] """
+        chats = []
+        unknown = []
+        for folder, chat_id, title, participant in self.catalog.chats(user_id):
+            # Participants of a record or members already in the membership index
+            if not participant:
+                status = self.channels.members.cached(chat_id, user_id)
+                if status == UNKNOWN:
+                    unknown += [chat_id]
+                    continue
+                # A lookup failed is cached as None until the timeout
+                if status is None or status in NOT_MEMBER:
+                    continue
+            chats += [(folder, title if title else f'No name {chat_id}')]
+        # Load the memberships not known for the next request, without wait
+        with self.seeding_lock:
+            unknown = [chat_id for chat_id in unknown if (chat_id, user_id) not in self.seeding]
+            self.seeding.update([(chat_id, user_id) for chat_id in unknown])
+        if unknown:
+            Thread(target=self.seed_members, args=(context.bot, unknown, user_id), daemon=True).start()
+        return chats
+
+    def seed_members(self, bot, chats, user_id):
+        for chat_id in chats:
+            try:
+                self.channels.members.status(bot, chat_id, user_id)
+            finally:
+                with self.seeding_lock:
+                    self.seeding.discard((chat_id, user_id))
+
+    def get_chat_title(self, folder_chat):
+        chat = self.catalog.chat(folder_chat)
+        if chat is None or not chat[1]:
+            return f'No name -{folder_chat}'
+        return chat[1]
 
     def get_folders_text(self, context, user_id):
-        folder_list = [folder for folder in os.listdir(self.records_folder) if os.path.isdir(f"{self.records_folder}/{folder}")]
-        if not folder_list:
+        chats = self.get_chats(context, user_id)
+        if not chats:
             return f"<b>No records!</b>"
         text = "<b>📼 Records:</b>\n"
-        for folder in folder_list:
-            chat_id = "-" + folder
-            try:
-                chat = context.bot.getChat(chat_id)
-                title = chat.title
-                user_chat = context.bot.get_chat_member(chat_id, user_id)
-                user_status = user_chat.status not in ['left', 'kicked']
-            except BadRequest:
-                title = f'No name {chat_id}'
-                user_status = True
-            if user_status and len(os.listdir(f"{self.records_folder}/{folder}") ) != 0:
-                text += f" - {title}\n"
+        for _, title in chats:
+            text += f" - {title}\n"
         return text
 
     def get_folders(self, context, user_id, keyID):
         buttons = []
-        # List all folders
-        folder_list = [folder for folder in os.listdir(self.records_folder) if os.path.isdir(f"{self.records_folder}/{folder}")]
-        for folder in folder_list:
-            chat_id = "-" + folder
-            try:
-                chat = context.bot.getChat(chat_id)
-                title = chat.title
-                user_chat = context.bot.get_chat_member(chat_id, user_id)
-                user_status = user_chat.status not in ['left', 'kicked']
-            except BadRequest:
-                logger.warning(f"This {chat_id} does not exist!")
-                title = f'No name {chat_id}'
-                user_status = True
-            if user_status and len(os.listdir(f"{self.records_folder}/{folder}") ) != 0:
-                buttons += [InlineKeyboardButton(title, callback_data=f"REC_DATA {keyID} {folder}")]
+        # List all chats
+        for folder, title in self.get_chats(context, user_id):
+            buttons += [InlineKeyboardButton(title, callback_data=f"REC_DATA {keyID} {folder}")]
         # Build reply markup
         if buttons:
             message = 'List of records:'
@@ -342,22 +662,11 @@ class Record:
         return message, reply_markup
 
     def get_records_text(self, context, keyID, folder_chat):
-        path = f"{self.records_folder}/{folder_chat}"
-        chat_id = "-" + folder_chat
-        try:
-            chat = context.bot.getChat(chat_id)
-            title = chat.title
-        except BadRequest:
-            title = f'No name {chat_id}'
+        title = self.get_chat_title(folder_chat)
         folder_text = ""
-        if os.path.isdir(path):
-            list_dir = [x for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]
-            for rec in list_dir:
-                if int(chat_id) in self.recording:
-                    if self.recording[int(chat_id)]['status'] in [WRITING, WAIT_STOP]:
-                        continue
-                filename = str(datetime.fromtimestamp(int(rec)))
-                folder_text += f" - 📼 {filename}\n"
+        for rec, start, end, msgs, size, media in self.catalog.records(folder_chat):
+            filename = str(datetime.fromtimestamp(int(rec)))
+            folder_text += f" - 📼 {filename} ({msgs} msgs)\n"
         if folder_text:
             text = f"<b>Records</b> <i>from</i> {title}\n"
             text += folder_text
@@ -366,29 +675,19 @@ class Record:
         return text
 
     def get_records_list(self, context, keyID, folder_chat):
-        path = f"{self.records_folder}/{folder_chat}"
         buttons = []
-        chat_id = "-" + folder_chat
-        try:
-            chat = context.bot.getChat(chat_id)
-            title = chat.title
-        except BadRequest:
-            title = f'No name {chat_id}'
+        title = self.get_chat_title(folder_chat)
         message = f'<b>No records</b> <i>from</i> {title}'
         reply_markup = InlineKeyboardMarkup(buttons)
-        if os.path.isdir(path):
-            list_dir = [x for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]
-            context.user_data[keyID]['folder'] = sorted(list_dir)
-            for idx, rec in enumerate(context.user_data[keyID]['folder']):
-                if int(chat_id) in self.recording:
-                    if self.recording[int(chat_id)]['status'] in [WRITING, WAIT_STOP]:
-                        continue
-                filename = str(datetime.fromtimestamp(int(rec)))
-                buttons += [InlineKeyboardButton("📼 " + filename, callback_data=f"REC_DOWNLOAD {keyID} {idx}")]
-            # Build reply markup
-            if buttons:
-                message = f"📼 <b>Records</b> <i>from</i> {title}"
-                reply_markup = InlineKeyboardMarkup(build_menu(buttons, 1, footer_buttons=InlineKeyboardButton("Cancel", callback_data=f"REC_CN {keyID} {folder_chat}")))
+        records = self.catalog.records(folder_chat)
+        context.user_data[keyID]['folder'] = [rec[0] for rec in records]
+        for idx, (rec, start, end, msgs, size, media) in enumerate(records):
+            filename = str(datetime.fromtimestamp(int(rec)))
+            buttons += [InlineKeyboardButton(f"📼 {filename} ({msgs} msgs)", callback_data=f"REC_DOWNLOAD {keyID} {idx}")]
+        # Build reply markup
+        if buttons:
+            message = f"📼 <b>Records</b> <i>from</i> {title}"
+            reply_markup = InlineKeyboardMarkup(build_menu(buttons, 1, footer_buttons=InlineKeyboardButton("Cancel", callback_data=f"REC_CN {keyID} {folder_chat}")))
         return message, reply_markup
 
     @rtype(['private', 'channel'])
@@ -412,6 +711,33 @@ class Record:
         # Send message
         context.bot.send_message(chat_id=update.effective_user.id, text=message, parse_mode='HTML', reply_markup=reply_markup)
 
+    @rtype(['private', 'channel'])
+    @register
+    def search(self, update, context):
+        """ Search in the records of the chats of the user """
+        user_id = update.effective_user.id
+        query = " ".join(context.args)
+        # In a chat only the records of the chat
+        if update.message.chat.type == 'private':
+            folders = dict(self.get_chats(context, user_id))
+        else:
+            folder = str(update.effective_chat.id)[1:]
+            folders = {folder: self.get_chat_title(folder)}
+        if not query:
+            text = "🔎 Write the words to search, example: <code>/search robot</code>"
+        else:
+            results = self.catalog.search(query, list(folders))
+            text = f"🔎 <b>{len(results)}</b> results for <i>{html.escape(query)}</i>\n"
+            for folder, record, date, msg_id, firstname, snippet in results:
+                record_name = str(datetime.fromtimestamp(int(record)))
+                msg_time = datetime.fromtimestamp(date).strftime('%Y-%m-%d %H:%M')
+                # Link to the message only in the supergroups
+                if folder.startswith('100'):
+                    msg_time = f'<a href="https://t.me/c/{folder[3:]}/{msg_id}">{msg_time}</a>'
+                text += f"\n📼 {html.escape(folders[folder])} - {record_name}\n"
+                text += f"{msg_time} <i>{html.escape(str(firstname))}</i>: {highlight(snippet)}\n"
+        context.bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True)
+
     @check_key_id('Error message')
     def rec_folder(self, update, context):
         query = update.callback_query
@@ -436,7 +762,7 @@ class Record:
         folder_download = context.user_data[keyID]['folder'][int(folder_idx)]
         path_document = f"{self.records_folder}/{folder_chat}/{folder_download}"
         # Document info
-        chat = context.bot.getChat("-" + folder_chat)
+        chat = self.channels.getChat(context.bot, "-" + folder_chat)
         #filename, _ = os.path.splitext(folder_download)
         filename = str(datetime.fromtimestamp(int(folder_download)))
         option = data[3] if len(data) == 4 else ""
@@ -455,6 +781,7 @@ class Record:
             elif option == 'delete':
                 # Remove file
                 shutil.rmtree(path_document)
+                self.catalog.remove(folder_chat, folder_download)
                 # Write text information
                 text = f"🧹 <b>Removed</b> 📼 {filename} <i>from</i> {chat.title}"
                 query.edit_message_text(text=text, parse_mode='HTML')
@@ -466,27 +793,26 @@ class Record:
         bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT)
         # Make path
         path_document = f"{self.records_folder}/{folder_chat}/{folder_download}"
+        # All lines on disk before read the record
+        self.writer.flush()
         # Document info
-        chat = bot.getChat("-" + folder_chat)
+        chat = self.channels.getChat(bot, "-" + folder_chat)
         filename = str(datetime.fromtimestamp(int(folder_download)))
         # Record information
         data_folder = os.listdir(path_document)
         if len(data_folder) > 1:
-            logger.info(f"Make a zip and send records of {folder_download} in {folder_chat}")
-            # path zip file
-            document = f"{path_document}/{filename}.zip"
-            # Zip folder
-            zip_record(document, path_document)
+            logger.info(f"Send zip records of {folder_download} in {folder_chat}")
+            # Zip folder, or the same zip if the record is not changed
+            document = self.archives.get(path_document, f"{folder_chat}-{folder_download}")
+            file_name = f"{filename}.zip"
         else:
             # Extract name document
-            file_record = data_folder[0]
+            file_name = data_folder[0]
             # make final path
-            document = f"{path_document}/{file_record}"
+            document = f"{path_document}/{file_name}"
         # Sending file
-        bot.send_document(chat_id=chat_id, document=open(document, 'rb'), caption=f"📼 <i>from</i> {chat.title}", parse_mode='HTML')
-        # Remove zip file if exist
-        if os.path.isfile(f"{path_document}/{filename}.zip"):
-            os.remove(f"{path_document}/{filename}.zip")
+        with open(document, 'rb') as fp:
+            bot.send_document(chat_id=chat_id, document=fp, filename=file_name, caption=f"📼 <i>from</i> {chat.title}", parse_mode='HTML')
 
     @check_key_id('Error message')
     def rec_cancel(self, update, context):
@@ -508,6 +834,7 @@ class Record:
 
     @rtype(['channel'])
     @register
+    @locked(update_chat)
     def player(self, update, context):
         chat_id = update.effective_chat.id
         # Filter and update data channel
@@ -538,13 +865,14 @@ class Record:
             context.user_data[keyID] = {'control': control, 'chat_id': chat_id}
             text = f"Do you want {type_message} this chat?\n"
             text += f"_[You can also use #start and #stop in your message]_"
-            self.recording[chat_id]['job_player'] = Autoreply(self.updater, context, chat_id, 'REC_PLAYER', text, self.cb_player, f'false {control}', keyID=keyID)
+            self.recording[chat_id]['job_player'] = Autoreply(self.ticker, context, chat_id, 'REC_PLAYER', text, self.cb_player, f'false {control}', keyID=keyID)
         else:
             text = "😅 *Ops!*\nI'm waiting your reply in another message"
             # Send message
             context.bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown')
 
     @check_key_id('Error message')
+    @locked(update_chat)
     def player_control(self, update, context):
         query = update.callback_query
         user = query.from_user
@@ -559,6 +887,7 @@ class Record:
         # remove key from user_data list
         del context.user_data[keyID]
 
+    @locked(callback_chat)
     def cb_player(self, bot, message_id, chat_id, data, user):
         # Extract keyID
         keyID = data[1]
@@ -640,6 +969,7 @@ class Record:
                     self.recording[chat_id]['msgs'].clear()
                 # Remove record
                 del self.recording[chat_id]
+                self.rates.pop(chat_id, None)
             return True
         # initialization recording chat
         records = self.settings['config'].get('records', {})
@@ -660,27 +990,19 @@ class Record:
         return False
 
     def save_voice(self, bot, chat_id, msg):
-        # Get file id picture big size
+        # Get file id voice
         file_id = msg['voice']
-        newFile = bot.get_file(file_id)
-        # Get filename
-        # https://stackoverflow.com/questions/10552188/python-split-url-to-find-image-name-and-extension
-        picture_page = newFile.file_path
-        disassembled = urlparse(picture_page)
-        file_name = basename(disassembled.path)
-        # Write text
+        # Voices are ogg files, the name from the unique id
+        file_name = f"{msg.get('file_unique_id', file_id)}.oga"
+        # Write text in a copy, the message in buffer is written again in a new record
+        msg = msg.copy()
         msg['text'] = f"Attached voice {file_name}"
-        # Attention chat in absolute value !!!!!!!!!!!!!
-        folder_name = str(chat_id)[1:]
-        folder_record = self.recording[chat_id]['folder_record']
-        # Path document
-        document = f"{self.records_folder}/{folder_name}/{folder_record}/{file_name}"
         # Download the document
-        doc = Downloader(newFile, document, file_name)
-        doc.start()
+        self.download(chat_id, msg, file_id, file_name)
         return msg
 
     @register
+    @locked(update_chat)
     def record_voice(self, update, context):
         # Filter and update data channel
         if self.record_filter(update, context):
@@ -690,29 +1012,25 @@ class Record:
         msg = make_dict_message(update, '')
         # Add photo message information
         msg['voice'] = update.message.voice.file_id
+        msg['file_unique_id'] = update.message.voice.file_unique_id
+        msg['file_size'] = update.message.voice.file_size
         # Add message in queue text
-        self.recording[chat_id]['msgs'].append(msg)
+        self.buffer(chat_id, msg)
         # Recording funcions
         if self.recording[chat_id]['status'] in [WRITING]:
             # Write message
             self.writing(context.bot, chat_id, msg)
 
     def save_document(self, bot, chat_id, msg):
-        # Get file id picture big size
+        # Get file id document
         file_id = msg['document']['file_id']
-        newFile = bot.get_file(file_id)
         # Get filename
         file_name = msg['document']['file_name']
-        # Attention chat in absolute value !!!!!!!!!!!!!
-        folder_name = str(chat_id)[1:]
-        folder_record = self.recording[chat_id]['folder_record']
-        # Path document
-        document = f"{self.records_folder}/{folder_name}/{folder_record}/{file_name}"
         # Download the document
-        doc = Downloader(newFile, document, file_name)
-        doc.start()
+        self.download(chat_id, msg, file_id, file_name)
 
     @register
+    @locked(update_chat)
     def record_document(self, update, context):
         # Filter and update data channel
         if self.record_filter(update, context):
@@ -724,8 +1042,10 @@ class Record:
         msg = make_dict_message(update, f"Attached document: {file_name}")
         # Document information
         msg['document'] = {'file_id': update.message.document.file_id, 'file_name': file_name}
+        msg['file_unique_id'] = update.message.document.file_unique_id
+        msg['file_size'] = update.message.document.file_size
         # Add message in queue text
-        self.recording[chat_id]['msgs'].append(msg)
+        self.buffer(chat_id, msg)
         # Recording funcions
         if self.recording[chat_id]['status'] in [WRITING]:
             # Write message
@@ -734,28 +1054,21 @@ class Record:
     def save_foto(self, bot, chat_id, msg):
         # Get file id picture big size
         file_id = msg['photo']
-        newFile = bot.get_file(file_id)
-        # Get filename
-        # https://stackoverflow.com/questions/10552188/python-split-url-to-find-image-name-and-extension
-        picture_page = newFile.file_path
-        disassembled = urlparse(picture_page)
-        file_name = basename(disassembled.path)
+        # Photos are jpg files, the name from the unique id
+        file_name = f"{msg.get('file_unique_id', file_id)}.jpg"
         # Write text
         text = f"Attached photo {file_name}"
         if msg['text']:
-            text+= f" - Caption: {msg['text']}"
+            text += f" - Caption: {msg['text']}"
+        # Write text in a copy, the message in buffer is written again in a new record
+        msg = msg.copy()
         msg['text'] = text
-        # Attention chat in absolute value !!!!!!!!!!!!!
-        folder_name = str(chat_id)[1:]
-        folder_record = self.recording[chat_id]['folder_record']
-        # Path document
-        document = f"{self.records_folder}/{folder_name}/{folder_record}/{file_name}"
         # Download the document
-        doc = Downloader(newFile, document, file_name)
-        doc.start()
+        self.download(chat_id, msg, file_id, file_name)
         return msg
 
     @register
+    @locked(update_chat)
     def record_photo(self, update, context):
         # Filter and update data channel
         if self.record_filter(update, context):
@@ -765,14 +1078,17 @@ class Record:
         msg = make_dict_message(update, update.message.caption)
         # Add photo message information
         msg['photo'] = update.message.photo[-1].file_id
+        msg['file_unique_id'] = update.message.photo[-1].file_unique_id
+        msg['file_size'] = update.message.photo[-1].file_size
         # Add message in queue text
-        self.recording[chat_id]['msgs'].append(msg)
+        self.buffer(chat_id, msg)
         # Recording funcions
         if self.recording[chat_id]['status'] in [WRITING]:
             # Write message
             self.writing(context.bot, chat_id, msg)
 
     @register
+    @locked(update_chat)
     def record(self, update, context):
         # If is an edited message overload standard message
         edited_message = False
@@ -800,7 +1116,7 @@ class Record:
             self.recording[chat_id]['status'] = WAIT_START
             # Send message
             text = "📼 Do you want *record* this chat? 📼"
-            self.recording[chat_id]['job_autoreply'] = Autoreply(self.updater, context, chat_id, 'REC_START', text, self.cb_start, 'false')
+            self.recording[chat_id]['job_autoreply'] = Autoreply(self.ticker, context, chat_id, 'REC_START', text, self.cb_start, 'false')
         elif stop and self.recording[chat_id]['status'] not in [IDLE, WAIT_START, WAIT_STOP]:
             # Wait reply
             self.recording[chat_id]['status'] = WAIT_STOP
@@ -809,30 +1125,21 @@ class Record:
             self.job_timer_delete(chat_id)
             # Send message
             text = "🚫 Do you want *stop* now? 🚫"
-            self.recording[chat_id]['job_autoreply'] = Autoreply(self.updater, context, chat_id, 'REC_STOP', text, self.cb_stop, 'true')
+            self.recording[chat_id]['job_autoreply'] = Autoreply(self.ticker, context, chat_id, 'REC_STOP', text, self.cb_stop, 'true')
         # Check before to start if require to wait
         if not self.recording[chat_id].get('delay_autorestart', False):
             # Auto record start
             self.auto_start(context, chat_id)
 
     def auto_start(self, context, chat_id):
-        # Minimum number of messages recordered
-        records = self.settings['config'].get('records', {})
-        size_record_chat = int(records.get('msgs', self.size_record_chat))
+        # Minimum number of messages in the autostart window
+        msgs, _ = self.autostart_limits(chat_id)
+        meter = self.rates.get(chat_id)
         rush_messages = False
-        if len(self.recording[chat_id]['msgs']) > size_record_chat // 2:
-            # Get first and last message
-            first = self.recording[chat_id]['msgs'][-size_record_chat // 2]
+        if meter is not None and self.recording[chat_id]['msgs']:
+            # Messages in the window ending with the last message
             last = self.recording[chat_id]['msgs'][-1]
-            # print(f"First: {first['date']} - {first['text']} -- Last: {last['date']} - {last['text']}")
-            # Measure delta from last and first message
-            delta = last['date'] - first['date']
-            # print(f"Delta: {delta}")
-            # If delta is minus or equal the minimum time enable rush_messages
-            records = self.settings['config'].get('records', {})
-            min_delta = int(records.get('min_start', self.min_delta))
-            if delta <= timedelta(minutes=min_delta):
-                rush_messages = True
+            rush_messages = meter.count(last.ts) >= msgs
         # Run Autostart
         if rush_messages and self.recording[chat_id]['status'] == IDLE:
             # Wait reply
@@ -841,7 +1148,7 @@ class Record:
             self.recording[chat_id]['autorestart'] = True
             # Send message
             text = "🔥 This chat getting *hot* 🔥\n📼 Do you want *record* this chat? 📼"
-            self.recording[chat_id]['job_autoreply'] = Autoreply(self.updater, context, chat_id, 'REC_START', text, self.cb_start, 'false')
+            self.recording[chat_id]['job_autoreply'] = Autoreply(self.ticker, context, chat_id, 'REC_START', text, self.cb_start, 'false')
 
     def writing(self, bot, chat_id, msg):
         # Attention chat in absolute value !!!!!!!!!!!!!
@@ -853,16 +1160,17 @@ class Record:
             self.save_document(bot, chat_id, msg)
         # Save photo if is included in msg
         if 'photo' in msg:
-            self.save_foto(bot, chat_id, msg)
+            msg = self.save_foto(bot, chat_id, msg)
         # Save voice if is included in msg
         if 'voice' in msg:
-            self.save_voice(bot, chat_id, msg)
+            msg = self.save_voice(bot, chat_id, msg)
         # Append new line on file
-        with open(f"{self.records_folder}/{folder_name}/{folder_record}/{file_name}", "a") as f:
-            data = [str(msg[name]) for name in MSG_TEXT_ORDER]
-            f.write(f"{self.separator}".join(data) + f"\n")
+        # The format of a record restored is from its file
+        line = encode(path_format(file_name), msg)
+        self.writer.write(f"{self.records_folder}/{folder_name}/{folder_record}/{file_name}", line)
+        self.catalog.message(folder_name, folder_record, msg, len(line.encode()))
         # log status
-        logger.info(f"Chat {chat_id} in WRITING {msg['text']}")
+        logger.debug(f"Chat {chat_id} in WRITING {msg['text']}")
 
     def init_record(self, bot, chat_id):
         # log status
@@ -873,7 +1181,7 @@ class Record:
         # Make new folder and file name
         folder_record = str(last_record['date'].timestamp()).split('.')[0]
         self.recording[chat_id]['folder_record'] = folder_record
-        file_name = str(last_record['date']) + "." + self.extension
+        file_name = str(last_record['date']) + "." + FORMATS[self.format]
         self.recording[chat_id]['file_name'] = file_name
         # Make chat folder if not exist
         if not os.path.isdir(f"{self.records_folder}/{folder_name}"):
@@ -883,13 +1191,14 @@ class Record:
         if not os.path.isdir(f"{self.records_folder}/{folder_name}/{folder_record}"):
             os.mkdir(f"{self.records_folder}/{folder_name}/{folder_record}")
             logger.info(f"Record directory {folder_record} created")
-        # Init file and write a file
-        # "x" - Create - will create a file, returns an error if the file exist
-        # "a" - Append - will create a file if the specified file does not exist
-        # "w" - Write - will create a file if the specified file does not exist
-        with open(f"{self.records_folder}/{folder_name}/{folder_record}/{file_name}", "x") as f:
-            # Write header
-            f.write(f"{self.separator}".join(MSG_TEXT_ORDER) + f"\n")
+        # Add the record in the catalog with the title of the chat
+        try:
+            title = self.channels.getChat(bot, chat_id).title
+        except BadRequest:
+            title = None
+        self.catalog.start(folder_name, folder_record, chat_id, title)
+        # Init file and write the header, fail if the file exist
+        self.writer.create(f"{self.records_folder}/{folder_name}/{folder_record}/{file_name}", header(self.format))
         # Copy all messages
         for msg in self.recording[chat_id]['msgs']:
             # Save all old messages
@@ -907,9 +1216,14 @@ class Record:
             logger.warning(f"No \'folder_record\' in recording")
             return
         folder_record = self.recording[chat_id]['folder_record']
+        self.catalog.stop(folder_name, folder_record)
+        # Close the record file
+        file_name = self.recording[chat_id].get('file_name', '')
+        self.writer.close(f"{self.records_folder}/{folder_name}/{folder_record}/{file_name}")
         # Send recordered registration
         self.send_record(bot, chat_id, folder_name, folder_record)
 
+    @locked(job_chat)
     def timer_stop(self, context: CallbackContext):
         # Extract chat ids
         chat_id = context.job.context
@@ -920,9 +1234,10 @@ class Record:
                 self.recording[chat_id]['status'] = WAIT_STOP
                 # Send message
                 text = "*TOK TOK* There is anyone here?\n🚫 Do you want *stop* now? 🚫"
-                self.recording[chat_id]['job_autoreply'] = Autoreply(self.updater, context, chat_id, 'REC_TIMER_STOP', text, self.cb_stop, 'true', keyID=chat_id)
+                self.recording[chat_id]['job_autoreply'] = Autoreply(self.ticker, context, chat_id, 'REC_TIMER_STOP', text, self.cb_stop, 'true', keyID=chat_id)
 
     @check_key_id('Error message')
+    @locked(update_chat)
     def start(self, update, context):
         query = update.callback_query
         user = query.from_user
@@ -935,6 +1250,7 @@ class Record:
         # remove key from user_data list
         del context.user_data[keyID]
 
+    @locked(callback_chat)
     def cb_start(self, bot, message_id, chat_id, data, user):
         # Stop the autoreply timer
         if chat_id in self.recording:
@@ -984,6 +1300,7 @@ class Record:
             text = "Error message"
             bot.edit_message_text(chat_id=chat_id, text=text, message_id=message_id)
 
+    @locked(job_chat)
     def reset_delay_autorestart(self, context: CallbackContext):
         # Extract chat ids
         chat_id = context.job.context
@@ -993,6 +1310,7 @@ class Record:
         logger.info(f"Reset delay autorestart chat: {chat_id}")
 
     @check_key_id('Error message')
+    @locked(update_chat)
     def stop(self, update, context):
         query = update.callback_query
         user = query.from_user
@@ -1005,6 +1323,7 @@ class Record:
         # remove key from user_data list
         del context.user_data[keyID]
 
+    @locked(update_chat)
     def timer_stop_cb(self, update, context):
         query = update.callback_query
         user = query.from_user
@@ -1013,6 +1332,7 @@ class Record:
         # Run callback stop
         self.cb_stop(context.bot, query.message.message_id, chat_id, data, user)
 
+    @locked(callback_chat)
     def cb_stop(self, bot, message_id, chat_id, data, user):
         # Stop the autoreply timer
         if chat_id in self.recording:
@@ -65,27 +65,36 @@ class Sites:
             self.settings['sites'] = {}
         # self serving keyID
         self.keyID = None
-        # Get the dispatcher to register handlers
-        dp = self.updater.dispatcher
-        # Add site list
-        dp.add_handler(CommandHandler("info", self.cmd_info))
-        # Add site conversation
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler('sites', self.start)],
-            states={
-                CHOOSING: [CallbackQueryHandler(self.choosing, pattern='SITE_CHOOSING'),
-                           MessageHandler(Filters.text, self.typing)],
-                EDIT: [CallbackQueryHandler(self.edit, pattern='SITE_EDIT')],
-            },
-            fallbacks=[CallbackQueryHandler(self.cancel, pattern='SITE_CANCEL'),
-                       CallbackQueryHandler(self.store, pattern='SITE_STORE'),
-                       CallbackQueryHandler(self.remove, pattern='SITE_REMOVE')],
-            per_message=False
-        )
-        dp.add_handler(conv_handler)
+        # Site conversation
+        self.conversation = None
+        # Register handlers
+        self.add_handlers(self.updater.dispatcher)
         # self counter
         self.counter = 0
 
+    def reload(self):
+        if 'sites' not in self.settings:
+            self.settings['sites'] = {}
+
+    def add_handlers(self, dp):
+        # Add site list
+        dp.add_handler(CommandHandler("info", self.cmd_info))
+        # Add site conversation, the same handler keeps the conversations in progress
+        if self.conversation is None:
+            self.conversation = ConversationHandler(
+                entry_points=[CommandHandler('sites', self.start)],
+                states={
+                    CHOOSING: [CallbackQueryHandler(self.choosing, pattern='SITE_CHOOSING'),
+                               MessageHandler(Filters.text, self.typing)],
+                    EDIT: [CallbackQueryHandler(self.edit, pattern='SITE_EDIT')],
+                },
+                fallbacks=[CallbackQueryHandler(self.cancel, pattern='SITE_CANCEL'),
+                           CallbackQueryHandler(self.store, pattern='SITE_STORE'),
+                           CallbackQueryHandler(self.remove, pattern='SITE_REMOVE')],
+                per_message=False
+            )
+        dp.add_handler(self.conversation)
+
     def getSites(self):
         buttons = []
         for title, link in self.settings['sites'].items():
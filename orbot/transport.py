@@ -0,0 +1,226 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import logging
+from time import time, monotonic
+from collections import deque
+from threading import Lock
+from urllib.request import Request, urlopen
+from telegram import Update
+from telegram.ext import (TypeHandler,
+                          CommandHandler,
+                          MessageHandler,
+                          CallbackQueryHandler,
+                          InlineQueryHandler,
+                          ChatMemberHandler,
+                          ConversationHandler,
+                          DispatcherHandlerStop)
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Number of latency samples stored
+LATENCY_SAMPLES = 1000
+# Default webhook configuration
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_CONNECTIONS = 40
+# Default polling configuration
+POLL_TIMEOUT = 30
+POLL_READ_LATENCY = 2.0
+# Policies for the updates received while the bot was off
+BACKLOG_DROP = 'drop'
+BACKLOG_REPLAY = 'replay'
+BACKLOG_RECORDING = 'recording'
+# Updates of each handler
+MESSAGES = {'message', 'edited_message', 'channel_post', 'edited_channel_post'}
+
+
+def handler_updates(handler):
+    """ Type of updates used from a handler """
+    if isinstance(handler, ConversationHandler):
+        handlers = handler.entry_points + handler.fallbacks + [h for state in handler.states.values() for h in state]
+        return set().union(*[handler_updates(h) for h in handlers])
+    if isinstance(handler, CommandHandler):
+        return {'message', 'edited_message'}
+    if isinstance(handler, MessageHandler):
+        return set(MESSAGES)
+    if isinstance(handler, CallbackQueryHandler):
+        return {'callback_query'}
+    if isinstance(handler, InlineQueryHandler):
+        return {'inline_query'}
+    if isinstance(handler, ChatMemberHandler):
+        updates = {ChatMemberHandler.MY_CHAT_MEMBER: {'my_chat_member'},
+                   ChatMemberHandler.CHAT_MEMBER: {'chat_member'}}
+        return updates.get(handler.chat_member_types, {'my_chat_member', 'chat_member'})
+    # Type handlers observe the other updates only
+    return set()
+
+
+class Latency:
+    """ Time from the message date to the handlers.
+        Telegram dates are in seconds, the synthetic updates use a float date.
+    """
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.samples = deque(maxlen=samples)
+        self.lock = Lock()
+
+    def track(self, update, context):
+        message = update.effective_message
+        if message is None or message.date is None:
+            return
+        with self.lock:
+            self.samples.append(time() - message.date.timestamp())
+
+    def stats(self):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return {'updates': 0}
+        return {'updates': len(samples),
+                'avg': f"{sum(samples) / len(samples):.3f}s",
+                'p95': f"{samples[min(len(samples) - 1, int(len(samples) * 0.95))]:.3f}s",
+                'max': f"{samples[-1]:.3f}s"}
+
+
+class Transport:
+    """ Receive updates with long polling or with a webhook.
+        The webhook is enabled with a 'webhook' block in the telegram settings:
+        {"url": "https://example.org", "secret": "path", "listen": "0.0.0.0", "port": 8443,
+         "cert": "cert.pem", "key": "private.key", "max_connections": 40}
+        Polling is tuned with a 'polling' block in the telegram settings:
+        {"timeout": 30, "read_latency": 2.0, "backlog": "drop" | "replay" | "recording"}
+        Only the updates used from the registered handlers are requested.
+    """
+
+    def __init__(self, updater, settings, recording=None):
+        self.updater = updater
+        self.settings = settings
+        # Function to check if a chat is recording
+        self.recording = recording
+        self.latency = Latency()
+        self.started = None
+        # Backlog counters
+        self.replayed = 0
+        self.dropped = 0
+        # Register handlers
+        self.add_handlers(self.updater.dispatcher)
+
+    def add_handlers(self, dp):
+        # Filter the backlog and track the latency before all handlers
+        dp.add_handler(TypeHandler(Update, self.backlog), group=-3)
+        dp.add_handler(TypeHandler(Update, self.latency.track), group=-2)
+
+    @property
+    def webhook(self):
+        return self.settings['telegram'].get('webhook', None)
+
+    @property
+    def polling(self):
+        return self.settings['telegram'].get('polling', {})
+
+    @property
+    def policy(self):
+        return self.polling.get('backlog', BACKLOG_REPLAY)
+
+    def allowed_updates(self):
+        """ All updates used from the registered handlers """
+        updates = set()
+        for handlers in self.updater.dispatcher.handlers.values():
+            for handler in handlers:
+                updates |= handler_updates(handler)
+        return sorted(updates)
+
+    def backlog(self, update, context):
+        """ Drop the old messages of the chats not recording """
+        message = update.message or update.channel_post
+        if message is None or message.date is None or message.date.timestamp() >= self.started:
+            return
+        if self.policy == BACKLOG_RECORDING:
+            if self.recording is None or not self.recording(message.chat.id):
+                self.dropped += 1
+                raise DispatcherHandlerStop()
+        self.replayed += 1
+
+    def start(self):
+        self.started = time()
+        webhook = self.webhook
+        allowed_updates = self.allowed_updates()
+        drop_pending_updates = self.policy == BACKLOG_DROP
+        logger.info(f"Allowed updates: {allowed_updates} backlog={self.policy}")
+        if webhook is None:
+            self.updater.start_polling(timeout=int(self.polling.get('timeout', POLL_TIMEOUT)),
+                                       read_latency=float(self.polling.get('read_latency', POLL_READ_LATENCY)),
+                                       allowed_updates=allowed_updates,
+                                       drop_pending_updates=drop_pending_updates)
+            logger.info("Transport polling")
+            return
+        path = webhook.get('secret', '')
+        url = webhook.get('url', None)
+        self.updater.start_webhook(listen=webhook.get('listen', WEBHOOK_LISTEN),
+                                   port=int(webhook.get('port', WEBHOOK_PORT)),
+                                   url_path=path,
+                                   cert=webhook.get('cert', None),
+                                   key=webhook.get('key', None),
+                                   webhook_url=f"{url.rstrip('/')}/{path}" if url is not None else None,
+                                   max_connections=int(webhook.get('max_connections', WEBHOOK_CONNECTIONS)),
+                                   allowed_updates=allowed_updates,
+                                   drop_pending_updates=drop_pending_updates)
+        logger.info(f"Transport webhook on port {webhook.get('port', WEBHOOK_PORT)}")
+
+    def stats(self):
+        values = ", ".join([f"{k}={v}" for k, v in self.latency.stats().items()])
+        text = "<b>Transport:</b>\n"
+        text += f" - {'webhook' if self.webhook is not None else 'polling'}: {values}\n"
+        text += f" - backlog {self.policy}: replayed={self.replayed}, dropped={self.dropped}\n"
+        return text
+
+
+def stand_in(url, count, chat_id=1, update_id=1):
+    """ Local stand-in of Telegram, POST synthetic updates to the webhook.
+        The messages are from a private chat and they are ignored by all handlers.
+        Return the time of each POST.
+    """
+    timings = []
+    for n in range(count):
+        update = {'update_id': update_id + n,
+                  'message': {'message_id': n + 1,
+                              'date': time(),
+                              'chat': {'id': chat_id, 'type': 'private', 'first_name': 'stand-in'},
+                              'from': {'id': chat_id, 'is_bot': False, 'first_name': 'stand-in'},
+                              'text': f"stand-in {n}"}}
+        request = Request(url, data=json.dumps(update).encode('utf-8'), headers={'Content-Type': 'application/json'})
+        start = monotonic()
+        with urlopen(request) as response:
+            response.read()
+        timings += [monotonic() - start]
+    return timings
+# EOF
@@ -32,9 +32,10 @@ import json
 import logging
 import csv
 import os
+from threading import Lock
 from functools import wraps
 from telegram.ext import ConversationHandler
-import zipfile
+from .outbox import NOTIFY
 # Offset flags
 OFFSET = 127462 - ord('A')
 
@@ -45,27 +46,36 @@ logger = logging.getLogger(__name__)
 
 def notify_group(bot, chats, text):
     for chat_id in chats:
-        bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown')
-
-
-def zip_record(file_name, dirName):
-    """ Reference:
-        https://thispointer.com/python-how-to-create-a-zip-archive-from-multiple-files-or-directory/
-        https://stackoverflow.com/questions/14438928/python-zip-a-sub-folder-and-not-the-entire-folder-path
-    """
-    with zipfile.ZipFile(file_name, 'w', zipfile.ZIP_DEFLATED) as zipObj:
-        # Iterate over all the files in directory
-        for filename in os.listdir(dirName):
-            if filename != os.path.relpath(file_name, dirName):
-                #create complete filepath of file in directory
-                filePath = os.path.join(dirName, filename)
-                # Add file to zip
-                zipObj.write(filePath, os.path.relpath(filePath, dirName))
+        bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown', priority=NOTIFY)
+
+
+class HandlerSet:
+    """ Collect handlers and replace all handlers of a dispatcher at once """
+
+    def __init__(self):
+        self.handlers = {}
+
+    def add_handler(self, handler, group=0):
+        self.handlers.setdefault(group, []).append(handler)
+
+    def apply(self, dispatcher):
+        # Swap the lists, an update in progress never sees a group half registered
+        dispatcher.handlers = self.handlers
+        dispatcher.groups = sorted(self.handlers)
+
+
+# Only one writer for each time
+SAVE_LOCK = Lock()
+
 
 def save_config(file_name, settings):
-    # Save to CSV file
-    with open(file_name, 'w') as fp:
-        json.dump(settings, fp, indent=4, sort_keys=True)
+    with SAVE_LOCK:
+        data = json.dumps(settings, indent=4, sort_keys=True)
+        # Write a new file and replace the old one, a crash never leaves half a file
+        tmp = f"{file_name}.tmp"
+        with open(tmp, 'w') as fp:
+            fp.write(data)
+        os.replace(tmp, file_name)
 
 
 def restricted(func):
@@ -135,11 +145,14 @@ def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
     return menu
 
 
-def isAdmin(update, context, user, chat_id=None):
+def isAdmin(update, context, user_id, chat_id=None, roster=None):
     if chat_id is None:
         chat_id = update.effective_chat.id
+    # Use the cached roster if available
+    if roster is not None:
+        return roster.isAdmin(context.bot, chat_id, user_id)
     for member in context.bot.getChatAdministrators(chat_id):
-        if member.user.username == user:
+        if member.user.id == user_id:
             return True
     return False
 
@@ -0,0 +1,141 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the orbot package (https://github.com/officinerobotiche/orbot or http://www.officinerobotiche.it).
+# Copyright (C) 2020, Raffaello Bonghi <raffaello@rnext.it>
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,
+# BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import logging
+from time import monotonic
+from threading import Lock
+from collections import OrderedDict
+
+from .formats import open_record
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Maximum number of files open
+WRITER_HANDLES = 32
+# Bytes written before a flush
+WRITER_BUFFER = 64 * 1024
+# Maximum seconds before a flush
+WRITER_INTERVAL = 2
+# When the data are synced on disk: never, flush or close
+FSYNC = ['never', 'flush', 'close']
+
+
+class RecordWriter:
+    """ Keep open the files of the recordings with a LRU of handles.
+        The lines are flushed by size and interval, not for every message.
+    """
+
+    def __init__(self, job_queue=None, handles=WRITER_HANDLES, buffer=WRITER_BUFFER, interval=WRITER_INTERVAL, fsync='close'):
+        if fsync not in FSYNC:
+            raise ValueError(f"fsync {fsync} not in {FSYNC}")
+        self.handles = int(handles)
+        self.buffer = int(buffer)
+        self.interval = interval
+        self.fsync = fsync
+        # path: [file, bytes not flushed, last flush]
+        self.files = OrderedDict()
+        self.lock = Lock()
+        # Statistics
+        self.n_open = 0
+        self.n_flush = 0
+        if job_queue is not None:
+            job_queue.run_repeating(self.tick, interval=interval, first=interval)
+
+    def handle(self, path, mode='a'):
+        if path in self.files:
+            self.files.move_to_end(path)
+            return self.files[path]
+        # Close the file used less recently
+        while len(self.files) >= self.handles:
+            old_path, entry = self.files.popitem(last=False)
+            self._close(old_path, entry)
+        entry = [open_record(path, mode, buffering=self.buffer), 0, monotonic()]
+        self.files[path] = entry
+        self.n_open += 1
+        logger.debug(f"Open {path}")
+        return entry
+
+    def create(self, path, header):
+        """ Create a new file, fail if exist """
+        with self.lock:
+            entry = self.handle(path, mode='x')
+            entry[0].write(header)
+            entry[1] += len(header)
+
+    def write(self, path, line):
+        with self.lock:
+            entry = self.handle(path)
+            entry[0].write(line)
+            entry[1] += len(line)
+            if entry[1] >= self.buffer:
+                self._flush(path, entry)
+
+    def _flush(self, path, entry):
+        entry[0].flush()
+        if self.fsync == 'flush':
+            os.fsync(entry[0].fileno())
+        entry[1] = 0
+        entry[2] = monotonic()
+        self.n_flush += 1
+        logger.debug(f"Flush {path}")
+
+    def _close(self, path, entry):
+        if entry[1]:
+            self._flush(path, entry)
+        if self.fsync != 'never':
+            os.fsync(entry[0].fileno())
+        entry[0].close()
+        logger.debug(f"Close {path}")
+
+    def flush(self, path=None):
+        """ Flush a file or all files """
+        with self.lock:
+            for name, entry in self.files.items():
+                if path is None or name == path:
+                    if entry[1]:
+                        self._flush(name, entry)
+
+    def close(self, path=None):
+        """ Close a file or all files """
+        with self.lock:
+            for name in [name for name in self.files if path is None or name == path]:
+                self._close(name, self.files.pop(name))
+
+    def tick(self, context):
+        now = monotonic()
+        with self.lock:
+            for path, entry in self.files.items():
+                if entry[1] and now - entry[2] >= self.interval:
+                    self._flush(path, entry)
+
+    def stats(self):
+        return {'open': len(self.files), 'opened': self.n_open, 'flush': self.n_flush}
+# EOF
@@ -88,6 +88,8 @@ setup(
         "Source": (project_homepage + "/tree/master")
     },
     install_requires=requirements,
+    # Records compressed with zstd
+    extras_require={'zstd': ['zstandard']},
     packages=find_packages(exclude=['examples', 'scripts', 'tests']),  # Required
     keywords=("telegram bot calendar manager"
               ),